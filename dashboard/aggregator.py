@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Multi-node Aggregator - one dashboard fanning out to many phones"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+NODE_TIMEOUT = 3.0      # per-node request timeout (seconds)
+ACTION_TIMEOUT = 15.0   # service start/restart on a node can take a few seconds
+FRESH_SECONDS = 5       # cached responses younger than this are served as-is
+STALE_SECONDS = 300     # older data is still served while a refresh runs in the background
+MAX_WORKERS = 8
+
+class NodeAggregator:
+    def __init__(self, node_urls, timeout=NODE_TIMEOUT):
+        self.nodes = {}
+        for url in node_urls:
+            url = url.strip().rstrip('/')
+            if url:
+                self.nodes[urlparse(url).netloc or url] = url
+        self.timeout = timeout
+        
+        # One pooled session shared by every worker keeps connections to each node alive
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(self.nodes), 1), pool_maxsize=MAX_WORKERS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='aggregator')
+        
+        self._cache = {}     # (node_id, path) -> entry
+        self._inflight = {}  # (node_id, path) -> Future, so concurrent callers share one fetch
+        self._lock = threading.Lock()
+    
+    def _fetch(self, node_id, path):
+        """Fetch path from one node and update the cache; failures keep the last good data"""
+        key = (node_id, path)
+        now = time.time()
+        try:
+            resp = self.session.get(self.nodes[node_id] + path, timeout=self.timeout)
+            resp.raise_for_status()
+            entry = {'data': resp.json(), 'error': None, 'fetched_at': now, 'checked_at': now}
+        except Exception as e:
+            with self._lock:
+                old = self._cache.get(key) or {}
+            entry = {'data': old.get('data'), 'error': str(e),
+                     'fetched_at': old.get('fetched_at'), 'checked_at': now}
+        
+        with self._lock:
+            self._cache[key] = entry
+            self._inflight.pop(key, None)
+        return entry
+    
+    def _refresh(self, node_id, path):
+        """Start (or join) a background fetch"""
+        key = (node_id, path)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self.pool.submit(self._fetch, node_id, path)
+                self._inflight[key] = future
+        return future
+    
+    def _describe(self, node_id, entry, now):
+        fetched_at = entry.get('fetched_at')
+        return {
+            'node': node_id,
+            'url': self.nodes[node_id],
+            'online': entry.get('error') is None,
+            'stale': fetched_at is None or now - fetched_at >= FRESH_SECONDS,
+            'age': round(now - fetched_at, 1) if fetched_at else None,
+            'error': entry.get('error'),
+            'data': entry.get('data'),
+        }
+    
+    def get_all(self, path):
+        """Get path from every node concurrently, using stale-while-revalidate caching.
+        
+        Fresh entries are returned directly; older ones (including failures) are
+        returned immediately while a refresh runs in the background, with
+        online/stale saying how current they are. Only a node's very first
+        fetch is waited for, and never longer than the per-node timeout, so slow
+        or offline nodes can't stall the view.
+        """
+        now = time.time()
+        results = {}
+        waiting = {}
+        
+        for node_id in self.nodes:
+            with self._lock:
+                entry = self._cache.get((node_id, path))
+                connecting = (node_id, path) in self._inflight
+            if entry is None:
+                if connecting:
+                    # Someone is already waiting on the first fetch; don't queue up behind it
+                    results[node_id] = {'data': None, 'error': 'Connecting', 'fetched_at': None}
+                else:
+                    waiting[node_id] = self._refresh(node_id, path)
+                continue
+            if now - entry['checked_at'] >= FRESH_SECONDS:
+                self._refresh(node_id, path)
+            if entry['fetched_at'] and now - entry['fetched_at'] >= STALE_SECONDS:
+                # Too old to show; keep reporting the node but not its data
+                entry = dict(entry, data=None)
+            results[node_id] = entry
+        
+        if waiting:
+            wait(waiting.values(), timeout=self.timeout + 0.5)
+        for node_id, future in waiting.items():
+            if future.done():
+                results[node_id] = future.result()
+            else:
+                results[node_id] = {'data': None, 'error': 'Timed out', 'fetched_at': None}
+        
+        now = time.time()
+        return [self._describe(node_id, results[node_id], now) for node_id in self.nodes]
+    
+    def get_status(self):
+        """Status of every node"""
+        return self.get_all('/api/status')
+    
+    def get_downloads(self):
+        """Downloads from every node merged into one list, newest first"""
+        nodes = self.get_all('/api/downloads')
+        downloads = []
+        for node in nodes:
+            for download in node.pop('data') or []:
+                downloads.append(dict(download, node=node['node']))
+        downloads.sort(key=lambda d: d.get('created_at') or '', reverse=True)
+        return {'nodes': nodes, 'downloads': downloads}
+    
+    def proxy(self, node_id, method, path, json=None):
+        """Forward a request to one node, returns (status_code, body)"""
+        if node_id not in self.nodes:
+            return 404, {'success': False, 'error': f'Unknown node: {node_id}'}
+        
+        try:
+            resp = self.session.request(method, self.nodes[node_id] + path, json=json,
+                                        timeout=ACTION_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            return 502, {'success': False, 'error': f'Node unreachable: {e}'}
+        try:
+            body = resp.json()
+        except ValueError:
+            body = {'success': False, 'error': 'Invalid response from node'}
+        
+        # The node's state just changed; make the next status poll refresh it
+        with self._lock:
+            entry = self._cache.get((node_id, '/api/status'))
+            if entry:
+                self._cache[(node_id, '/api/status')] = dict(entry, checked_at=0)
+        return resp.status_code, body
@@ -5,8 +5,10 @@ import os
 import subprocess
 import socket
 import json
+import hmac
 from datetime import datetime
-from flask import Flask, render_template, jsonify, request, send_file
+from functools import wraps
+from flask import Flask, render_template, jsonify, request, Response
 
 try:
     import psutil
@@ -17,13 +19,35 @@ except ImportError:
 # Import our new managers
 from downloads import DownloadManager
 from todos import TodoManager
+from profiler import SamplingProfiler, SlowRequestLog
+from fileserve import serve_file
+from aggregator import NodeAggregator
+import servicelogs
+import cleanup
 
 app = Flask(__name__)
-DASHBOARD_PORT = 5000
+DASHBOARD_PORT = int(os.environ.get('VPS_DASHBOARD_PORT', '5000'))
+
+# Aggregator mode: comma separated dashboard URLs, e.g. http://phone1:5000,http://phone2:5000
+NODE_URLS = [u for u in os.environ.get('VPS_NODES', '').split(',') if u.strip()]
+
+# Debug endpoints are disabled unless a token is configured
+DEBUG_TOKEN = os.environ.get('VPS_DEBUG_TOKEN')
+SLOW_REQUEST_MS = int(os.environ.get('VPS_SLOW_REQUEST_MS', '1000'))
 
 # Initialize managers
 download_mgr = DownloadManager()
 todo_mgr = TodoManager()
+profiler = SamplingProfiler()
+slow_log = SlowRequestLog(SLOW_REQUEST_MS, logger=app.logger)
+aggregator = NodeAggregator(NODE_URLS) if NODE_URLS else None
+log_watcher = servicelogs.LogWatcher()
+
+todo_mgr.on_reminder(lambda todo: app.logger.info('Todo due: %s (%s)', todo['title'], todo['due_date']))
+
+# Periodic retention, reconciliation and compaction of downloads.db
+cleanup.on_expire(download_mgr.forget_paths)
+cleanup.start_scheduler(logger=app.logger)
 
 SERVICES = {
     'ssh': {'port': 22, 'process': 'sshd', 'name': 'SSH Server'},
@@ -58,6 +82,8 @@ def get_system_stats():
         stats['cpu_percent'] = psutil.cpu_percent(interval=0.5)
         stats['memory_percent'] = psutil.virtual_memory().percent
         stats['disk_percent'] = psutil.disk_usage('/').percent
+    # Space promised to downloads that haven't written it yet
+    stats['disk_reserved'] = download_mgr.space.reserved_total()
     return stats
 
 def is_port_open(port):
@@ -76,6 +102,29 @@ def get_service_status(sid):
     svc = SERVICES[sid]
     return {'id': sid, 'name': svc['name'], 'port': svc['port'], 'running': is_port_open(svc['port'])}
 
+@app.before_request
+def track_request_start():
+    if request.endpoint == 'debug_profile':
+        return  # Profiling is slow by design
+    rule = request.url_rule.rule if request.url_rule else request.path
+    slow_log.start(f'{request.method} {rule}')
+
+@app.teardown_request
+def track_request_end(exc=None):
+    slow_log.finish()
+
+def require_debug_token(f):
+    """Only allow requests carrying the configured debug token"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_TOKEN:
+            return jsonify({'error': 'Debug endpoints disabled (set VPS_DEBUG_TOKEN)'}), 403
+        token = request.headers.get('X-Debug-Token') or request.args.get('token', '')
+        if not hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode()):
+            return jsonify({'error': 'Invalid debug token'}), 401
+        return f(*args, **kwargs)
+    return wrapper
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -95,13 +144,16 @@ def start_service(sid):
         return jsonify({'success': False}), 404
     
     try:
+        # Children append straight to their log file, so output survives dashboard restarts
+        log = servicelogs.open_log(sid)
+        
         if sid == 'ssh':
             # SSH is typically always running on Ubuntu
             pass
         elif sid == 'nginx':
             # Start HTTP server (nginx replacement)
             subprocess.Popen(['python3', '-m', 'http.server', '8081'], 
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, 
+                           stdout=log, stderr=subprocess.STDOUT, 
                            cwd='/tmp')
         elif sid == 'mariadb':
             # Start database server (MariaDB replacement)
@@ -117,19 +169,24 @@ class DBHandler(http.server.BaseHTTPRequestHandler):
     def log_message(self, format, *args): pass
 httpd = socketserver.TCPServer(('', 3307), DBHandler)
 httpd.serve_forever()
-'''], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+'''], stdout=log, stderr=subprocess.STDOUT)
         elif sid == 'redis':
             # Check if redis-server exists in our test environment
+            # Redis daemonizes, so point its own logfile at ours
+            logfile = servicelogs.log_path('redis')
             try:
-                subprocess.run(['./test-services/redis-stable/src/redis-server', '--port', '6379', '--daemonize', 'yes'], 
+                subprocess.run(['./test-services/redis-stable/src/redis-server', '--port', '6379', '--daemonize', 'yes',
+                              '--logfile', logfile], 
                              check=True, cwd='/home/vortex/Documents/VPS-on-phone')
             except:
                 # Fallback for systems without our compiled Redis
-                subprocess.run(['redis-server', '--daemonize', 'yes'], check=False)
+                subprocess.run(['redis-server', '--daemonize', 'yes', '--logfile', logfile], check=False)
         elif sid == 'filebrowser':
             subprocess.Popen(['filebrowser', '--port', '8080', '--database', '/tmp/filebrowser.db',
                             '--baseURL', '/filebrowser', '--root', '/home/vortex/Documents/VPS-on-phone'], 
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                           stdout=log, stderr=subprocess.STDOUT)
+        
+        log.close()
         
         # Wait a moment for the service to start
         import time
@@ -180,6 +237,33 @@ def stop_service(sid):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/service/<sid>/logs', methods=['GET'])
+def service_logs(sid):
+    """Tail a service log, or with ?follow=1 stream new lines as server-sent events"""
+    if sid not in SERVICES:
+        return jsonify({'error': 'Unknown service'}), 404
+    
+    lines = request.args.get('lines', 100, type=int)
+    if request.args.get('follow') not in ('1', 'true'):
+        return jsonify({'service': sid, 'lines': servicelogs.tail(sid, lines)})
+    
+    def stream():
+        # Subscribe before tailing so nothing written in between is missed
+        follower = log_watcher.follow(sid)
+        try:
+            for line in servicelogs.tail(sid, lines):
+                yield f'data: {line}\n\n'
+            for new in follower:
+                if not new:
+                    yield ': keepalive\n\n'
+                for line in new:
+                    yield f'data: {line}\n\n'
+        finally:
+            follower.unsubscribe()
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/service/<sid>/restart', methods=['POST'])
 def restart(sid):
     if sid not in SERVICES:
@@ -240,8 +324,9 @@ def filebrowser_proxy(path=''):
 
 @app.route('/api/downloads', methods=['GET'])
 def get_downloads():
-    """Get all downloads"""
-    downloads = download_mgr.get_downloads()
+    """Get downloads, optionally only the newest ?limit=N"""
+    limit = request.args.get('limit', type=int)
+    downloads = download_mgr.get_downloads(limit, batch_id=request.args.get('batch'))
     return jsonify(downloads)
 
 @app.route('/api/downloads', methods=['POST'])
@@ -255,8 +340,31 @@ def add_download():
         return jsonify({'success': False, 'error': 'URL required'}), 400
     
     try:
-        download_id = download_mgr.add_download(url, format_type)
+        download_id = download_mgr.add_download(url, format_type,
+                                                checksum=data.get('checksum'),
+                                                checksum_algo=data.get('checksum_algo'))
         return jsonify({'success': True, 'id': download_id})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/downloads/bulk', methods=['POST'])
+def add_downloads_bulk():
+    """Queue a list of URLs and/or playlist/channel URLs"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
+    urls = data.get('urls')
+    
+    if not isinstance(urls, list):
+        return jsonify({'success': False, 'error': 'urls must be a list'}), 400
+    
+    try:
+        batch_id, ids = download_mgr.add_downloads_bulk(urls, data.get('format'))
+        return jsonify({'success': True, 'batch_id': batch_id, 'ids': ids})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -269,13 +377,13 @@ def delete_download(download_id):
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/downloads/<download_id>/file', methods=['GET'])
+@app.route('/api/downloads/<download_id>/file', methods=['GET', 'HEAD'])
 def get_download_file(download_id):
-    """Download the completed file"""
+    """Download the completed file (supports Range, If-Range and conditional requests)"""
     filepath = download_mgr.get_download_path(download_id)
     
     if filepath:
-        return send_file(filepath, as_attachment=True)
+        return serve_file(filepath)
     else:
         return jsonify({'error': 'File not found or not ready'}), 404
 
@@ -287,7 +395,10 @@ def get_download_file(download_id):
 def get_todos():
     """Get todos with optional filter"""
     filter_by = request.args.get('filter', 'all')
-    todos = todo_mgr.get_todos(filter_by)
+    category = request.args.get('category')
+    page = request.args.get('page', type=int)
+    per_page = request.args.get('per_page', type=int)
+    todos = todo_mgr.get_todos(filter_by, category, page, per_page)
     return jsonify(todos)
 
 @app.route('/api/todos', methods=['POST'])
@@ -346,11 +457,92 @@ def get_todo_stats():
     stats = todo_mgr.get_stats()
     return jsonify(stats)
 
+@app.route('/api/todos/overdue', methods=['GET'])
+def get_overdue_todos():
+    """Get open todos past their due date"""
+    return jsonify(todo_mgr.get_overdue())
+
+@app.route('/api/todos/upcoming', methods=['GET'])
+def get_upcoming_todos():
+    """Get the next deadlines, optionally only those due within ?hours"""
+    limit = request.args.get('limit', type=int)
+    hours = request.args.get('hours', type=float)
+    within = hours * 3600 if hours is not None else None
+    return jsonify(todo_mgr.get_upcoming(limit, within))
+
+@app.route('/api/todos/cache', methods=['GET'])
+def get_todo_cache_stats():
+    """Get todo cache hit ratio"""
+    return jsonify(todo_mgr.get_cache_stats())
+
 @app.route('/api/todos/categories', methods=['GET'])
 def get_categories():
     """Get all categories"""
     categories = todo_mgr.get_categories()
     return jsonify(categories)
 
+# ============================================================================
+# Multi-node Aggregator API Routes
+# ============================================================================
+
+def require_aggregator(f):
+    """Only available when the dashboard is started with VPS_NODES"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not aggregator:
+            return jsonify({'error': 'Aggregator mode disabled (set VPS_NODES)'}), 404
+        return f(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/nodes/status', methods=['GET'])
+@require_aggregator
+def get_nodes_status():
+    """Get status of every node"""
+    return jsonify(aggregator.get_status())
+
+@app.route('/api/nodes/downloads', methods=['GET'])
+@require_aggregator
+def get_nodes_downloads():
+    """Get downloads from every node merged into one list"""
+    return jsonify(aggregator.get_downloads())
+
+@app.route('/api/nodes/<node_id>/service/<sid>/<action>', methods=['POST'])
+@require_aggregator
+def node_service_action(node_id, sid, action):
+    """Start, stop or restart a service on one node"""
+    if action not in ('start', 'stop', 'restart'):
+        return jsonify({'success': False, 'error': f'Unknown action: {action}'}), 404
+    
+    status, body = aggregator.proxy(node_id, 'POST', f'/api/service/{sid}/{action}')
+    return jsonify(body), status
+
+# ============================================================================
+# Debug API Routes
+# ============================================================================
+
+@app.route('/api/debug/profile', methods=['GET'])
+@require_debug_token
+def debug_profile():
+    """Sample all threads and return collapsed stacks for a flamegraph"""
+    try:
+        seconds = float(request.args.get('seconds', 5))
+    except ValueError:
+        return jsonify({'error': 'seconds must be a number'}), 400
+    
+    result = profiler.profile(seconds)
+    if result is None:
+        return jsonify({'error': 'A profile is already running'}), 409
+    
+    counts, samples = result
+    response = Response(profiler.collapse(counts), mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    return response
+
+@app.route('/api/debug/slow-requests', methods=['GET'])
+@require_debug_token
+def debug_slow_requests():
+    """Get requests that exceeded the slow request threshold"""
+    return jsonify({'threshold_ms': SLOW_REQUEST_MS, 'requests': slow_log.get_entries()})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=DASHBOARD_PORT)
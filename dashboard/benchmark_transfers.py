@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""Transfer Benchmark - threaded vs async download engine against a local server
+
+Serves test files from this process and runs each engine in a fresh child
+process (with a throwaway HOME, so real downloads are untouched) that
+downloads them all at once, then reports wall time, throughput, peak RSS
+and peak thread count.
+
+    python3 benchmark_transfers.py --transfers 64 --size-mb 4
+    python3 benchmark_transfers.py --transfers 100 --rate-kb 256   # slow, phone-like links
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ENGINES = ('threads', 'async')
+WRITE_SLICE = 64 * 1024
+
+def make_handler(payload, rate, chunked):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def log_message(self, *args):
+            pass
+        
+        def _headers(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            if chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Connection', 'close')
+            self.end_headers()
+        
+        def do_HEAD(self):
+            self._headers()
+        
+        def do_GET(self):
+            self._headers()
+            view = memoryview(payload)
+            started = time.time()
+            try:
+                for pos in range(0, len(view), WRITE_SLICE):
+                    piece = view[pos:pos + WRITE_SLICE]
+                    if chunked:
+                        self.wfile.write(b'%x\r\n' % len(piece) + piece + b'\r\n')
+                    else:
+                        self.wfile.write(piece)
+                    if rate:
+                        # Per-connection throttle
+                        ahead = (pos + len(piece)) / rate - (time.time() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+                if chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+    return Handler
+
+def start_server(payload, rate, chunked):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(payload, rate, chunked))
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    thread = threading.Thread(target=server.serve_forever, name='bench-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def run_child(engine, base_url, transfers, checksum):
+    """Runs in the child: download everything with one engine and print a JSON summary"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import downloads
+    import transfer
+    
+    # Same concurrency for both engines, otherwise the download workers cap at 3
+    if engine == 'threads':
+        downloads.MAX_CONCURRENT_DOWNLOADS = transfers
+    transfer.MAX_TRANSFERS = transfers
+    manager = downloads.DownloadManager()
+    
+    baseline = rss_kb()
+    peak = {'rss': baseline, 'threads': threading.active_count()}
+    done = threading.Event()
+    
+    def sample():
+        while not done.is_set():
+            peak['rss'] = max(peak['rss'], rss_kb())
+            peak['threads'] = max(peak['threads'], threading.active_count())
+            time.sleep(0.05)
+    sampler = threading.Thread(target=sample, name='bench-sampler')
+    sampler.daemon = True
+    sampler.start()
+    
+    started = time.time()
+    ids = [manager.add_download(f'{base_url}/file{i}.bin', checksum=checksum) for i in range(transfers)]
+    while True:
+        rows = [d for d in manager.get_downloads() if d['id'] in ids]
+        if all(d['status'] in ('completed', 'failed') for d in rows):
+            break
+        time.sleep(0.05)
+    elapsed = time.time() - started
+    done.set()
+    sampler.join()
+    
+    completed = [d for d in rows if d['status'] == 'completed']
+    failed = [d for d in rows if d['status'] == 'failed']
+    total_bytes = sum(d['downloaded'] for d in completed)
+    print(json.dumps({
+        'engine': engine,
+        'completed': len(completed),
+        'failed': len(failed),
+        'errors': sorted({d['error'] for d in failed})[:3],
+        'seconds': round(elapsed, 2),
+        'mb_per_s': round(total_bytes / elapsed / 1048576, 1),
+        'rss_delta_mb': round((peak['rss'] - baseline) / 1024, 1),
+        'peak_rss_mb': round(peak['rss'] / 1024, 1),
+        'peak_threads': peak['threads'],
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transfers', type=int, default=64, help='concurrent downloads (default 64)')
+    parser.add_argument('--size-mb', type=float, default=4, help='size of each file (default 4)')
+    parser.add_argument('--rate-kb', type=int, default=0, help='per-connection limit in KB/s (default none)')
+    parser.add_argument('--chunked', action='store_true', help='serve with chunked transfer encoding')
+    parser.add_argument('--engine', choices=ENGINES, help='only run one engine')
+    parser.add_argument('--child', nargs=3, metavar=('ENGINE', 'URL', 'CHECKSUM'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.child:
+        engine, url, checksum = args.child
+        run_child(engine, url, args.transfers, checksum)
+        return
+    
+    payload = os.urandom(int(args.size_mb * 1048576))
+    checksum = hashlib.sha256(payload).hexdigest()
+    server = start_server(payload, args.rate_kb * 1024, args.chunked)
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    
+    print(f'{args.transfers} transfers x {args.size_mb} MB'
+          + (f' at {args.rate_kb} KB/s each' if args.rate_kb else '')
+          + (' (chunked)' if args.chunked else ''))
+    print(f'{"engine":<8} {"ok":>4} {"failed":>6} {"seconds":>8} {"MB/s":>7} {"+RSS MB":>8} {"peak RSS":>9} {"threads":>8}')
+    
+    for engine in [args.engine] if args.engine else ENGINES:
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home, VPS_TRANSFER_ENGINE=engine, VPS_MIN_FREE_MB='0')
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--transfers', str(args.transfers),
+                 '--child', engine, url, checksum],
+                env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f'{engine:<8} crashed:\n{result.stderr}')
+            continue
+        r = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f'{engine:<8} {r["completed"]:>4} {r["failed"]:>6} {r["seconds"]:>8} {r["mb_per_s"]:>7} '
+              f'{r["rss_delta_mb"]:>8} {r["peak_rss_mb"]:>9} {r["peak_threads"]:>8}')
+        for error in r['errors']:
+            print(f'         {error}')
+    
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
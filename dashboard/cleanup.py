@@ -1,11 +1,40 @@
 #!/usr/bin/env python3
 """Utility script to clean up database"""
 import os
+import gzip
+import json
+import shutil
 import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
 
 # Database paths
 DOWNLOADS_DB = os.path.expanduser("~/.vps-on-phone/downloads.db")
 TODOS_DB = os.path.expanduser("~/.vps-on-phone/todos.db")
+DOWNLOAD_DIR = os.path.expanduser("~/vps-downloads")
+ARCHIVE_DIR = os.path.expanduser("~/.vps-on-phone/archive")
+BACKUP_DIR = os.path.expanduser("~/.vps-on-phone/backups")
+DATABASES = {'downloads': DOWNLOADS_DB, 'todos': TODOS_DB}
+
+# Retention policy for the downloads table. Rows in an active state are never expired.
+RETENTION_POLICY = {
+    'max_age_days': {'completed': 90, 'failed': 14},  # per status
+    'max_rows': 500,                                   # newest rows kept, regardless of status
+}
+ACTIVE_STATUSES = ('resolving', 'queued', 'downloading', 'processing')
+ORPHAN_GRACE_SECONDS = 3600   # ignore recently touched files (yt-dlp temp/part files)
+VACUUM_BATCH_PAGES = 128      # pages freed per incremental_vacuum step
+MAINTENANCE_INTERVAL = 6 * 3600
+
+# Online snapshots
+BACKUP_INTERVAL = 24 * 3600
+BACKUP_KEEP = 7              # snapshots kept per database
+BACKUP_PAGES = 64            # pages copied per backup step
+BACKUP_SLEEP = 0.01          # pause after each step (and on BUSY/LOCKED) so writers can get in
+BACKUP_MAX_RESTARTS = 3
+
+_expire_listeners = []
 
 def clear_downloads():
     """Clear all downloads"""
@@ -33,6 +62,316 @@ def clear_todos():
     conn.close()
     print("✓ All todos cleared")
 
+def _archive_rows(rows, reason):
+    """Append rows to this month's compressed JSONL archive"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"downloads-{datetime.now():%Y-%m}.jsonl.gz")
+    archived_at = datetime.now().isoformat()
+    
+    # Appending creates a new gzip member; readers see one continuous stream
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        for row in rows:
+            record = dict(row)
+            record['archived_at'] = archived_at
+            record['archive_reason'] = reason
+            f.write(json.dumps(record, default=str) + '\n')
+    return path
+
+def on_expire(callback):
+    """Call callback(ids) whenever download rows are expired in this process"""
+    _expire_listeners.append(callback)
+
+def _archived_paths():
+    """Real paths of every file referenced by archived rows"""
+    paths = set()
+    if not os.path.isdir(ARCHIVE_DIR):
+        return paths
+    for name in os.listdir(ARCHIVE_DIR):
+        if not name.endswith('.jsonl.gz'):
+            continue
+        with gzip.open(os.path.join(ARCHIVE_DIR, name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                filepath = json.loads(line).get('filepath')
+                if filepath:
+                    paths.add(os.path.realpath(filepath))
+    return paths
+
+def _expire_rows(conn, rows, reason, delete_files):
+    """Archive rows, then remove them (and optionally their files)"""
+    if not rows:
+        return 0
+    
+    _archive_rows(rows, reason)
+    conn.executemany('DELETE FROM downloads WHERE id = ?', [(row['id'],) for row in rows])
+    conn.commit()
+    for listener in list(_expire_listeners):
+        listener([row['id'] for row in rows])
+    
+    if delete_files:
+        for row in rows:
+            if row['filepath'] and os.path.isfile(row['filepath']):
+                os.remove(row['filepath'])
+    return len(rows)
+
+def apply_retention(policy=RETENTION_POLICY, dry_run=False, delete_files=False):
+    """Expire download rows by age, status and count; returns number of rows expired.
+    
+    Only the history is archived and removed; the downloaded files stay on
+    disk unless delete_files is set.
+    """
+    if not os.path.exists(DOWNLOADS_DB):
+        return 0
+    
+    conn = sqlite3.connect(DOWNLOADS_DB)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    expired = {}
+    
+    for status, days in policy.get('max_age_days', {}).items():
+        if status in ACTIVE_STATUSES:
+            continue
+        cutoff = datetime.now() - timedelta(days=days)
+        c.execute('SELECT * FROM downloads WHERE status = ? AND created_at < ?', (status, cutoff))
+        for row in c.fetchall():
+            expired[row['id']] = row
+    
+    max_rows = policy.get('max_rows')
+    if max_rows is not None:
+        c.execute(f'''SELECT * FROM downloads
+                      WHERE status NOT IN ({', '.join('?' * len(ACTIVE_STATUSES))})
+                      ORDER BY created_at DESC LIMIT -1 OFFSET ?''',
+                  (*ACTIVE_STATUSES, max_rows))
+        for row in c.fetchall():
+            expired[row['id']] = row
+    
+    count = len(expired) if dry_run else _expire_rows(conn, list(expired.values()), 'retention', delete_files)
+    conn.close()
+    return count
+
+def reconcile(delete_orphans=False, dry_run=False):
+    """Match the downloads table against DOWNLOAD_DIR.
+    
+    Completed rows whose file is gone are archived and removed. Files that
+    neither a row nor the archive references (retention keeps files by
+    default) are reported, and deleted only if delete_orphans is set.
+    """
+    result = {'missing_rows': 0, 'orphan_files': []}
+    if not os.path.exists(DOWNLOADS_DB):
+        return result
+    
+    conn = sqlite3.connect(DOWNLOADS_DB)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM downloads')
+    rows = c.fetchall()
+    
+    missing = [row for row in rows
+               if row['status'] == 'completed' and not (row['filepath'] and os.path.exists(row['filepath']))]
+    result['missing_rows'] = len(missing) if dry_run else _expire_rows(conn, missing, 'missing_file', False)
+    conn.close()
+    
+    known = {os.path.realpath(row['filepath']) for row in rows if row['filepath']}
+    known |= _archived_paths()
+    now = time.time()
+    if os.path.isdir(DOWNLOAD_DIR):
+        for entry in os.scandir(DOWNLOAD_DIR):
+            if not entry.is_file() or os.path.realpath(entry.path) in known:
+                continue
+            if now - entry.stat().st_mtime < ORPHAN_GRACE_SECONDS:
+                continue
+            result['orphan_files'].append(entry.path)
+            if delete_orphans and not dry_run:
+                os.remove(entry.path)
+    
+    return result
+
+def compact(max_pages=None):
+    """Reclaim free pages with incremental vacuum; returns pages freed"""
+    if not os.path.exists(DOWNLOADS_DB):
+        return 0
+    
+    conn = sqlite3.connect(DOWNLOADS_DB)
+    c = conn.cursor()
+    c.execute('PRAGMA auto_vacuum')
+    if c.fetchone()[0] != 2:
+        # One-off conversion of databases created before incremental mode
+        c.execute('PRAGMA freelist_count')
+        freed = c.fetchone()[0]
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM')
+        conn.close()
+        return freed
+    
+    freed = 0
+    while max_pages is None or freed < max_pages:
+        c.execute('PRAGMA freelist_count')
+        free = c.fetchone()[0]
+        if free == 0:
+            break
+        step = min(free, VACUUM_BATCH_PAGES)
+        if max_pages is not None:
+            step = min(step, max_pages - freed)
+        # Small batches keep each write lock short so download threads are not stalled
+        c.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+        freed += step
+    
+    conn.close()
+    return freed
+
+def run_maintenance():
+    """Apply retention, reconcile against disk and compact; returns a summary"""
+    expired = apply_retention()
+    reconciled = reconcile()
+    freed = compact()
+    return {
+        'expired_rows': expired,
+        'missing_rows': reconciled['missing_rows'],
+        'orphan_files': reconciled['orphan_files'],
+        'pages_freed': freed,
+    }
+
+class _BackupRestarted(Exception):
+    pass
+
+def _backup_db(src, dst):
+    """Copy src into dst in small page batches so writers get the lock in between.
+    
+    Every write from another connection restarts an incremental backup, so a
+    busy database falls back to a single step; in WAL mode that only holds a
+    read snapshot and still doesn't block writers.
+    """
+    state = {'remaining': None, 'restarts': 0}
+    
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        state['remaining'] = remaining
+        # backup() itself only sleeps on BUSY/LOCKED, so pace the steps here
+        if remaining:
+            time.sleep(BACKUP_SLEEP)
+    
+    try:
+        src.backup(dst, pages=BACKUP_PAGES, progress=progress, sleep=BACKUP_SLEEP)
+    except _BackupRestarted:
+        src.backup(dst)
+
+def snapshot(name):
+    """Take an online, compressed snapshot of one database; returns its path"""
+    db_path = DATABASES[name]
+    if not os.path.exists(db_path):
+        return None
+    
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    # Microseconds keep back-to-back snapshots from overwriting each other
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    tmp_path = os.path.join(BACKUP_DIR, f'.{name}-{stamp}.db')
+    path = os.path.join(BACKUP_DIR, f'{name}-{stamp}.db.gz')
+    
+    try:
+        src = sqlite3.connect(db_path)
+        dst = sqlite3.connect(tmp_path)
+        _backup_db(src, dst)
+        result = dst.execute('PRAGMA quick_check').fetchone()[0]
+        src.close()
+        dst.close()
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f'Snapshot of {name} failed quick_check: {result}')
+        
+        with open(tmp_path, 'rb') as f_in, gzip.open(path + '.part', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.replace(path + '.part', path)
+    finally:
+        for leftover in (tmp_path, path + '.part'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    
+    rotate_snapshots(name)
+    return path
+
+def list_snapshots(name=None):
+    """Snapshot paths, newest first"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    names = [name] if name else list(DATABASES)
+    paths = [os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR)
+             if f.endswith('.db.gz') and f.split('-', 1)[0] in names]
+    return sorted(paths, reverse=True)
+
+def rotate_snapshots(name, keep=BACKUP_KEEP):
+    """Delete all but the newest keep snapshots of a database"""
+    for path in list_snapshots(name)[keep:]:
+        os.remove(path)
+
+def restore(path):
+    """Restore a snapshot into its live database (named by the file prefix)"""
+    name = os.path.basename(path).split('-', 1)[0]
+    if name not in DATABASES:
+        raise ValueError(f'Cannot tell which database {path} belongs to')
+    
+    tmp_path = os.path.join(BACKUP_DIR, f'.restore-{name}.db')
+    try:
+        with gzip.open(path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        
+        src = sqlite3.connect(tmp_path)
+        result = src.execute('PRAGMA quick_check').fetchone()[0]
+        if result != 'ok':
+            src.close()
+            raise sqlite3.DatabaseError(f'Snapshot failed quick_check: {result}')
+        
+        # Going through SQLite rather than replacing the file keeps other connections consistent
+        dst = sqlite3.connect(DATABASES[name])
+        src.backup(dst)
+        src.close()
+        dst.close()
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return name
+
+def run_backups():
+    """Snapshot every database; returns the new snapshot paths"""
+    return [path for path in (snapshot(name) for name in DATABASES) if path]
+
+def _last_snapshot_time():
+    snapshots = list_snapshots()
+    return max(os.path.getmtime(path) for path in snapshots) if snapshots else None
+
+def _schedule(name, interval, job, logger, last_run=None):
+    """Run job every interval seconds in a background thread.
+    
+    The first run is due interval seconds after last_run() (a timestamp, or
+    None if unknown), so restarts don't keep pushing a job back; a job that
+    is overdue or has no record runs straight away.
+    """
+    def loop():
+        previous = last_run() if last_run else None
+        delay = max(0, previous + interval - time.time()) if previous else 0
+        while True:
+            time.sleep(delay)
+            delay = interval
+            try:
+                summary = job()
+                if logger:
+                    logger.info('%s: %s', name, summary)
+            except Exception as e:
+                if logger:
+                    logger.error('%s failed: %s', name, e)
+    
+    thread = threading.Thread(target=loop, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def start_scheduler(logger=None):
+    """Run downloads maintenance and database snapshots periodically"""
+    return [
+        _schedule('downloads-maintenance', MAINTENANCE_INTERVAL, run_maintenance, logger),
+        _schedule('database-backup', BACKUP_INTERVAL, run_backups, logger, last_run=_last_snapshot_time),
+    ]
+
 if __name__ == "__main__":
     import sys
     
@@ -41,9 +380,20 @@ if __name__ == "__main__":
         print("  python3 cleanup.py downloads  - Clear all downloads")
         print("  python3 cleanup.py todos      - Clear all todos")
         print("  python3 cleanup.py all        - Clear everything")
+        print("  python3 cleanup.py retention [--delete-files] [--dry-run]")
+        print("                                - Archive and expire old download history")
+        print("  python3 cleanup.py reconcile [--delete-orphans] [--dry-run]")
+        print("                                - Match downloads against files on disk")
+        print("  python3 cleanup.py compact    - Reclaim free space in downloads.db")
+        print("  python3 cleanup.py maintain   - Retention, reconcile and compact")
+        print("  python3 cleanup.py backup     - Snapshot downloads.db and todos.db")
+        print("  python3 cleanup.py snapshots  - List snapshots")
+        print("  python3 cleanup.py restore <snapshot.db.gz>  - Restore a snapshot")
         sys.exit(1)
     
     action = sys.argv[1]
+    flags = sys.argv[2:]
+    dry_run = '--dry-run' in flags
     
     if action == "downloads":
         clear_downloads()
@@ -52,6 +402,34 @@ if __name__ == "__main__":
     elif action == "all":
         clear_downloads()
         clear_todos()
+    elif action == "retention":
+        count = apply_retention(dry_run=dry_run, delete_files='--delete-files' in flags)
+        print(f"✓ {count} downloads {'would be ' if dry_run else ''}archived and expired")
+        if count and not dry_run:
+            print("  (restart the dashboard to drop its caches)")
+    elif action == "reconcile":
+        result = reconcile(delete_orphans='--delete-orphans' in flags, dry_run=dry_run)
+        print(f"✓ {result['missing_rows']} rows with missing files {'found' if dry_run else 'archived'}")
+        for path in result['orphan_files']:
+            print(f"  orphan: {path}")
+    elif action == "compact":
+        print(f"✓ {compact()} pages reclaimed")
+    elif action == "maintain":
+        summary = run_maintenance()
+        print(f"✓ {summary['expired_rows']} expired, {summary['missing_rows']} missing, "
+              f"{len(summary['orphan_files'])} orphan files, {summary['pages_freed']} pages reclaimed")
+    elif action == "backup":
+        for path in run_backups():
+            print(f"✓ {path}")
+    elif action == "snapshots":
+        for path in list_snapshots():
+            print(f"  {path} ({os.path.getsize(path) // 1024} KB)")
+    elif action == "restore":
+        if not flags:
+            print("Usage: python3 cleanup.py restore <snapshot.db.gz>")
+            sys.exit(1)
+        name = restore(flags[0])
+        print(f"✓ {name} restored from {flags[0]} (restart the dashboard to drop its caches)")
     else:
         print(f"Unknown action: {action}")
         sys.exit(1)
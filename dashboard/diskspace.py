@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Disk Space Admission Control - reserve room before a download starts"""
+
+import os
+import shutil
+import threading
+
+# Never let downloads push free space below this floor
+MIN_FREE_BYTES = int(os.environ.get('VPS_MIN_FREE_MB', '500')) * 1024 * 1024
+RECHECK_SECONDS = 30  # space can also be freed outside the dashboard
+
+class InsufficientSpace(Exception):
+    pass
+
+class SpaceReserver:
+    """Tracks space promised to in-flight downloads on one filesystem.
+    
+    A reservation only succeeds if free space minus everything already
+    reserved stays above the floor. Jobs that don't fit wait until another
+    reservation is released; a job that can't fit even with nothing else
+    reserved fails straight away.
+    """
+    
+    def __init__(self, path, min_free=MIN_FREE_BYTES):
+        self.path = path
+        self.min_free = min_free
+        self._reserved = {}
+        self._cond = threading.Condition()
+    
+    def _available(self):
+        return shutil.disk_usage(self.path).free - self.min_free - sum(self._reserved.values())
+    
+    def fits(self, size):
+        """Check whether size bytes could be reserved right now"""
+        with self._cond:
+            return self._available() >= size
+    
+    def _insufficient(self, size):
+        free = shutil.disk_usage(self.path).free
+        return InsufficientSpace(
+            f'Not enough disk space: need {size // 1048576} MB plus a '
+            f'{self.min_free // 1048576} MB floor, {free // 1048576} MB free')
+    
+    def reserve(self, key, size):
+        """Block until size bytes can be reserved for key"""
+        with self._cond:
+            while self._available() < size:
+                if not self._reserved:
+                    raise self._insufficient(size)
+                self._cond.wait(timeout=RECHECK_SECONDS)
+            self._reserved[key] = size
+    
+    def try_reserve(self, key, size):
+        """Reserve size bytes for key if they fit right now; never waits"""
+        with self._cond:
+            if self._available() >= size:
+                self._reserved[key] = size
+                return True
+            if not self._reserved:
+                raise self._insufficient(size)
+            return False
+    
+    def resize(self, key, size):
+        """Shrink what is reserved for key once part of it is already on disk"""
+        with self._cond:
+            if key in self._reserved and size < self._reserved[key]:
+                self._reserved[key] = size
+                self._cond.notify_all()
+    
+    def release(self, key):
+        """Give back whatever is reserved for key (safe to call more than once)"""
+        with self._cond:
+            if self._reserved.pop(key, None) is not None:
+                self._cond.notify_all()
+    
+    def reserved_total(self):
+        with self._cond:
+            return sum(self._reserved.values())
@@ -2,19 +2,49 @@
 """Download Manager Backend"""
 
 import os
+import hashlib
 import sqlite3
 import uuid
 import threading
 import time
 import re
+import json
+import queue
+import shutil
 import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
-from urllib.parse import urlparse, unquote
+from urllib.parse import urlparse, unquote, parse_qs
+from postprocess import PostProcessor, audio_command, merge_command, PRIORITY_MERGE, PRIORITY_TRANSCODE
+from diskspace import SpaceReserver, InsufficientSpace
+from transfer import AsyncTransferEngine
 
 # Download storage directory
 DOWNLOAD_DIR = os.path.expanduser("~/vps-downloads")
 DB_PATH = os.path.expanduser("~/.vps-on-phone/downloads.db")
+# Intermediate yt-dlp streams waiting for merge/transcode
+STAGING_DIR = os.path.join(DOWNLOAD_DIR, ".staging")
+PATH_CACHE_SIZE = 256
+MAX_CONCURRENT_DOWNLOADS = 3
+MAX_RESOLVE_WORKERS = 4
+MAX_BULK_URLS = 500
+CHUNK_SIZE = 256 * 1024          # larger writes fragment flash storage less
+PROGRESS_INTERVAL = 512 * 1024   # bytes between progress updates
+# 'async' runs every plain HTTP(S) download on one event loop instead of a thread each
+TRANSFER_ENGINE = os.environ.get('VPS_TRANSFER_ENGINE', 'threads')
+
+# yt-dlp format selectors; mp4 fetches separate streams for the post-processor to merge
+YTDLP_FORMATS = {
+    'mp3': 'bestaudio/best',
+    'mp4': 'bv*[ext=mp4]/bv*,ba[ext=m4a]/ba/b',
+}
+
+INSERT_SQL = '''INSERT INTO downloads
+                (id, url, filename, filepath, status, progress, size, downloaded, format,
+                 checksum_algo, expected_checksum, batch_id, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
 
 # Ensure directories exist
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -23,12 +53,31 @@ os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 class DownloadManager:
     def __init__(self):
         self.db = DB_PATH
+        # Completed download id -> filepath, so repeated range requests skip SQLite
+        self._path_cache = OrderedDict()
+        self._path_cache_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.postprocessor = PostProcessor()
+        self.space = SpaceReserver(DOWNLOAD_DIR)
         self.init_db()
+        self.transfers = AsyncTransferEngine(self) if TRANSFER_ENGINE == 'async' else None
+        
+        # A fixed set of workers, however many downloads are queued
+        for i in range(MAX_CONCURRENT_DOWNLOADS):
+            worker = threading.Thread(target=self._download_worker, name=f'download-worker-{i}')
+            worker.daemon = True
+            worker.start()
+        
+        self._recover_interrupted()
     
     def init_db(self):
         """Initialize database"""
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
+        # Only takes effect on a fresh database; cleanup.compact() converts old ones
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL lets readers and online backups run alongside download writers
+        c.execute('PRAGMA journal_mode = WAL')
         c.execute('''CREATE TABLE IF NOT EXISTS downloads
                      (id TEXT PRIMARY KEY,
                       url TEXT,
@@ -43,12 +92,25 @@ class DownloadManager:
                       created_at TIMESTAMP,
                       completed_at TIMESTAMP)''')
         
-        # Migration: Add format column if it doesn't exist
-        try:
-            c.execute("SELECT format FROM downloads LIMIT 1")
-        except sqlite3.OperationalError:
-            # Column doesn't exist, add it
-            c.execute("ALTER TABLE downloads ADD COLUMN format TEXT DEFAULT 'auto'")
+        # Migration: Add columns that didn't exist in older databases
+        migrations = [
+            ('format', "TEXT DEFAULT 'auto'"),
+            ('checksum_algo', 'TEXT'),
+            ('checksum', 'TEXT'),
+            ('expected_checksum', 'TEXT'),
+            ('batch_id', 'TEXT'),
+            ('stage', 'TEXT'),
+            ('stage_timings', 'TEXT'),
+        ]
+        for column, definition in migrations:
+            try:
+                c.execute(f"SELECT {column} FROM downloads LIMIT 1")
+            except sqlite3.OperationalError:
+                # Column doesn't exist, add it
+                c.execute(f"ALTER TABLE downloads ADD COLUMN {column} {definition}")
+        
+        # Listing and retention both scan by age
+        c.execute('CREATE INDEX IF NOT EXISTS idx_downloads_created_at ON downloads (created_at)')
         
         conn.commit()
         conn.close()
@@ -61,35 +123,106 @@ class DownloadManager:
         ]
         return any(re.match(pattern, url) for pattern in youtube_patterns)
     
-    def _get_youtube_title(self, url):
-        """Get YouTube video title before downloading"""
+    def _is_playlist_url(self, url):
+        """Check if URL is a YouTube playlist or channel rather than a single video"""
+        if not self._is_youtube_url(url):
+            return False
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        if 'list' in query and 'v' not in query:
+            return True
+        return bool(re.match(r'/(playlist|channel/|c/|user/|@)', parsed.path))
+    
+    def _expand_playlist(self, url, depth=0):
+        """List (url, title) for every video in a playlist or channel"""
+        result = subprocess.run(
+            ['python3', '-m', 'yt_dlp', '--flat-playlist', '--dump-single-json', url],
+            capture_output=True,
+            text=True,
+            timeout=120
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f'yt-dlp exited with code {result.returncode}')
+        
+        entries = []
+        for entry in json.loads(result.stdout).get('entries') or []:
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if not entry_url:
+                continue
+            # Channels list their tabs (videos, shorts, ...) as nested playlists
+            if entry.get('ie_key') == 'YoutubeTab' or self._is_playlist_url(entry_url):
+                if depth < 1:
+                    entries.extend(self._expand_playlist(entry_url, depth + 1))
+                continue
+            title = entry.get('title')
+            entries.append((entry_url, re.sub(r'[<>:"/\\|?*]', '', title) if title else None))
+        return entries
+    
+    def _probe_youtube(self, url, format_type):
+        """Resolve a video's title and the size of the streams its format selector picks.
+        
+        Returns (title, size); either may be unknown (None / 0). Raises
+        ValueError if the video has no stream matching the requested format.
+        """
         try:
             result = subprocess.run(
-                ['python3', '-m', 'yt_dlp', '--get-title', '--no-playlist', url],
+                ['python3', '-m', 'yt_dlp', '-f', YTDLP_FORMATS[format_type],
+                 '--print', '%(filesize,filesize_approx)s\t%(title)s', '--no-playlist', '--simulate', url],
                 capture_output=True,
                 text=True,
-                timeout=10
+                timeout=30
             )
-            if result.returncode == 0 and result.stdout.strip():
-                # Clean the title for use as filename
-                title = result.stdout.strip()
+        except (OSError, subprocess.TimeoutExpired):
+            return None, 0
+        
+        if result.returncode != 0:
+            if 'Requested format is not available' in result.stderr:
+                raise ValueError(f'No {format_type} format available for {url}')
+            return None, 0
+        
+        # One line per selected stream (video and audio for mp4)
+        title = None
+        size = 0
+        for line in result.stdout.splitlines():
+            value, _, name = line.partition('\t')
+            if value.replace('.', '', 1).isdigit():
+                size += int(float(value))
+            if name.strip() and not title:
                 # Remove invalid filename characters
-                title = re.sub(r'[<>:"/\\|?*]', '', title)
-                return title
-        except:
-            pass
-        return None
+                title = re.sub(r'[<>:"/\\|?*]', '', name.strip())
+        return title, size
     
-    def add_download(self, url, format_type=None):
-        """Add a new download with auto-detection"""
-        download_id = str(uuid.uuid4())[:8]
-        
-        # Auto-detect format based on URL if not specified
+    def _parse_checksum(self, checksum, algo):
+        """Normalize an expected checksum, accepting 'algo:hexdigest' or a bare digest"""
+        if checksum and ':' in checksum:
+            algo, checksum = checksum.split(':', 1)
+        algo = (algo or 'sha256').lower()
+        # shake_* digests need a length, so they can't be checked like the rest
+        if algo not in hashlib.algorithms_guaranteed or algo.startswith('shake_'):
+            raise ValueError(f'Unsupported checksum algorithm: {algo}')
+        if checksum:
+            checksum = checksum.strip().lower()
+            if not re.fullmatch(r'[0-9a-f]+', checksum):
+                raise ValueError('Checksum must be a hex digest')
+            expected_length = hashlib.new(algo).digest_size * 2
+            if len(checksum) != expected_length:
+                raise ValueError(f'A {algo} checksum is {expected_length} hex digits, got {len(checksum)}')
+        return checksum or None, algo
+    
+    def _check_format(self, format_type):
+        if format_type and format_type not in YTDLP_FORMATS:
+            raise ValueError(f'Unsupported format: {format_type}')
+        return format_type
+    
+    def _new_id(self):
+        return str(uuid.uuid4())[:8]
+    
+    def _build_row(self, download_id, url, format_type=None, title=None, status='queued',
+                   batch_id=None, checksum_algo='sha256', expected_checksum=None, size=0):
+        """Build an INSERT_SQL row, auto-detecting format and filename from the URL"""
         if self._is_youtube_url(url):
             if not format_type:
                 format_type = 'mp4'  # Default to video for YouTube
-            # Get video title for proper filename
-            title = self._get_youtube_title(url)
             if title:
                 filename = f'{title}.{format_type}'
             else:
@@ -99,22 +232,254 @@ class DownloadManager:
             filename = self._get_filename_from_url(url)
         
         filepath = os.path.join(DOWNLOAD_DIR, filename)
+        return (download_id, url, filename, filepath, status, 0, size, 0, format_type,
+                checksum_algo, expected_checksum, batch_id, datetime.now())
+    
+    def add_download(self, url, format_type=None, checksum=None, checksum_algo=None):
+        """Add a new download with auto-detection.
+        
+        For direct file downloads, checksum_algo (default sha256) is computed while
+        streaming; if checksum is given the download fails when it doesn't match.
+        """
+        download_id = self._new_id()
+        expected_checksum, checksum_algo = self._parse_checksum(checksum, checksum_algo)
+        
+        title = None
+        size = 0
+        if self._is_youtube_url(url):
+            if expected_checksum:
+                raise ValueError('Checksums are only supported for direct file downloads')
+            format_type = self._check_format(format_type) or 'mp4'
+            # Get video title for proper filename, and check the format exists
+            title, size = self._probe_youtube(url, format_type)
+        
+        row = self._build_row(download_id, url, format_type, title=title, size=size,
+                              checksum_algo=checksum_algo, expected_checksum=expected_checksum)
         
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
-        c.execute('''INSERT INTO downloads 
-                     (id, url, filename, filepath, status, progress, size, downloaded, format, created_at)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (download_id, url, filename, filepath, 'queued', 0, 0, 0, format_type, datetime.now()))
+        c.execute(INSERT_SQL, row)
         conn.commit()
         conn.close()
         
-        # Start download in background thread
-        thread = threading.Thread(target=self._download_file, args=(download_id,))
+        self._start_download(download_id, row[8])
+        return download_id
+    
+    def add_downloads_bulk(self, urls, format_type=None):
+        """Queue many URLs (videos, files, playlists or channels) in one go.
+        
+        Rows are inserted in a single transaction with status 'resolving' and the
+        ids are returned straight away. Playlists get a placeholder row that is
+        replaced by one row per video, all tagged with the returned batch_id.
+        """
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            raise ValueError('urls must be a list of strings')
+        self._check_format(format_type)
+        urls = [url.strip() for url in urls if url.strip()]
+        if not urls:
+            raise ValueError('At least one URL required')
+        if len(urls) > MAX_BULK_URLS:
+            raise ValueError(f'At most {MAX_BULK_URLS} URLs per request')
+        
+        batch_id = self._new_id()
+        rows = []
+        for url in urls:
+            download_id = self._new_id()
+            if self._is_playlist_url(url):
+                rows.append((download_id, url, 'Playlist', None, 'resolving', 0, 0, 0, 'playlist',
+                             None, None, batch_id, datetime.now()))
+            else:
+                rows.append(self._build_row(download_id, url, format_type, status='resolving',
+                                            batch_id=batch_id))
+        
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        c.executemany(INSERT_SQL, rows)
+        conn.commit()
+        conn.close()
+        
+        thread = threading.Thread(target=self._resolve_batch, args=(batch_id, rows, format_type),
+                                  name=f'resolve-{batch_id}')
         thread.daemon = True
         thread.start()
         
-        return download_id
+        return batch_id, [row[0] for row in rows]
+    
+    def _resolve_batch(self, batch_id, rows, format_type):
+        """Expand playlists and resolve video titles and formats concurrently, then queue the downloads.
+        
+        Videos listed directly are probed here, so one without the requested
+        format fails straight away. Videos from playlists already have their
+        titles; their formats are resolved when a download worker admits them.
+        """
+        playlists = [row for row in rows if row[8] == 'playlist']
+        videos = [row for row in rows if row[8] != 'playlist' and self._is_youtube_url(row[1])]
+        
+        with ThreadPoolExecutor(max_workers=MAX_RESOLVE_WORKERS) as pool:
+            expansions = {row[0]: pool.submit(self._expand_playlist, row[1]) for row in playlists}
+            probes = {row[0]: pool.submit(self._probe_youtube, row[1], row[8]) for row in videos}
+        
+        new_rows = []
+        failed = []
+        expanded = []
+        for playlist_id, future in expansions.items():
+            try:
+                entries = future.result()
+            except Exception as e:
+                failed.append(('failed', str(e), playlist_id))
+                continue
+            if not entries:
+                failed.append(('failed', 'Playlist is empty', playlist_id))
+                continue
+            expanded.append((playlist_id,))
+            for entry_url, title in entries:
+                new_rows.append(self._build_row(self._new_id(), entry_url, format_type, title=title,
+                                                batch_id=batch_id))
+        
+        renames = []
+        for row in videos:
+            try:
+                title, size = probes[row[0]].result()
+            except ValueError as e:
+                failed.append(('failed', str(e), row[0]))
+                continue
+            filename = f'{title}.{row[8]}' if title else row[2]
+            renames.append((filename, os.path.join(DOWNLOAD_DIR, filename), size, row[0]))
+        
+        # Everything the batch learned lands in one transaction
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        c.executemany(INSERT_SQL, new_rows)
+        c.executemany('UPDATE downloads SET filename = ?, filepath = ?, size = ? WHERE id = ?', renames)
+        c.executemany('UPDATE downloads SET status = ?, error = ? WHERE id = ?', failed)
+        c.executemany('DELETE FROM downloads WHERE id = ?', expanded)
+        c.execute('''UPDATE downloads SET status = 'queued'
+                     WHERE batch_id = ? AND status = 'resolving' AND format != 'playlist' ''',
+                  (batch_id,))
+        conn.commit()
+        conn.close()
+        
+        failed_ids = {download_id for _, _, download_id in failed}
+        for row in rows + new_rows:
+            if row[8] != 'playlist' and row[0] not in failed_ids:
+                self._start_download(row[0], row[8])
+    
+    def _recover_interrupted(self):
+        """Pick up downloads the last run left unfinished.
+        
+        Queued and resolving rows are only tracked in memory once inserted, so
+        they are queued again (unresolved videos are resolved on admission).
+        Transfers and post-processing can't be resumed half way, so those rows
+        fail with their partial files removed and can simply be added again.
+        """
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        c.execute('''SELECT id, filepath, format, status FROM downloads
+                     WHERE status IN ('queued', 'resolving', 'downloading', 'processing')
+                     ORDER BY created_at''')
+        requeue = []
+        for download_id, filepath, format_type, status in c.fetchall():
+            if format_type == 'playlist':
+                error = 'Interrupted by restart before the playlist was expanded'
+            elif status in ('queued', 'resolving'):
+                requeue.append((download_id, format_type))
+                continue
+            else:
+                error = 'Interrupted by restart'
+                shutil.rmtree(os.path.join(STAGING_DIR, download_id), ignore_errors=True)
+                if format_type not in YTDLP_FORMATS and filepath and os.path.isfile(filepath):
+                    os.remove(filepath)
+            self._set_stage(c, download_id, 'failed')
+            c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
+                      ('failed', error, download_id))
+        c.executemany("UPDATE downloads SET status = 'queued' WHERE id = ?",
+                      [(download_id,) for download_id, _ in requeue])
+        conn.commit()
+        conn.close()
+        
+        for download_id, format_type in requeue:
+            self._start_download(download_id, format_type)
+    
+    def _start_download(self, download_id, format_type=None):
+        """Queue a download for the workers (or the async engine for plain files)"""
+        if self.transfers and format_type == 'file':
+            self.transfers.submit(download_id)
+            return
+        self._queue.put(download_id)
+    
+    def _download_worker(self):
+        while True:
+            download_id = self._queue.get()
+            try:
+                self._run_download(download_id)
+            except Exception:
+                pass  # _download_file records its own failures
+    
+    def _estimate_size(self, url, format_type, known_size=0):
+        """Best-effort size in bytes needed on disk for a download (0 if unknown).
+        
+        Raises ValueError if a YouTube video has no stream in the requested format.
+        """
+        if format_type in YTDLP_FORMATS:
+            size = known_size or self._probe_youtube(url, format_type)[1]
+            # Staged streams and the post-processed output exist side by side
+            return size * 2
+        
+        try:
+            response = requests.head(url, allow_redirects=True, timeout=10)
+            return int(response.headers.get('content-length', 0))
+        except Exception:
+            return 0
+    
+    def _admit(self, download_id):
+        """Reserve disk space for a download, waiting while it doesn't fit.
+        
+        Returns the download's format, or None if it was dropped or can never fit.
+        """
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        c.execute('SELECT url, format, size FROM downloads WHERE id = ?', (download_id,))
+        row = c.fetchone()
+        if not row:
+            conn.close()
+            return None
+        
+        url, format_type, known_size = row
+        try:
+            needed = self._estimate_size(url, format_type, known_size or 0)
+            if not self.space.fits(needed):
+                self._set_stage(c, download_id, 'space_wait')
+                conn.commit()
+            self.space.reserve(download_id, needed)
+        except (InsufficientSpace, ValueError) as e:
+            self._set_stage(c, download_id, 'failed')
+            c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
+                      ('failed', str(e), download_id))
+            conn.commit()
+            conn.close()
+            return None
+        
+        conn.close()
+        return format_type
+    
+    def _run_download(self, download_id):
+        """Reserve disk space, then download (runs on a download worker).
+        
+        Admission happens on the worker so a big batch only runs
+        MAX_CONCURRENT_DOWNLOADS size estimates (a yt-dlp process each for
+        YouTube) and holds that many reservations at a time, instead of one
+        per queued download.
+        """
+        format_type = self._admit(download_id)
+        if not format_type:
+            return
+        
+        try:
+            self._download_file(download_id)
+        finally:
+            # YouTube reservations are held until post-processing is done
+            if format_type not in YTDLP_FORMATS:
+                self.space.release(download_id)
     
     def _get_filename_from_url(self, url):
         """Extract filename from URL"""
@@ -133,26 +498,38 @@ class DownloadManager:
         
         return filename
     
+    def _preallocate(self, f, size):
+        """Reserve the file's blocks up front so it is laid out contiguously"""
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return True
+        except (AttributeError, OSError):
+            return False
+    
     def _download_file(self, download_id):
         """Download file in background"""
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
+        filepath = None
+        f = None
         
         try:
             # Get download info
-            c.execute('SELECT url, filepath, format FROM downloads WHERE id = ?', (download_id,))
+            c.execute('''SELECT url, filepath, format, checksum_algo, expected_checksum
+                         FROM downloads WHERE id = ?''', (download_id,))
             row = c.fetchone()
             if not row:
                 return
             
-            url, filepath, format_type = row
+            url, filepath, format_type, checksum_algo, expected_checksum = row
             
             # Update status to downloading
+            self._set_stage(c, download_id, 'fetch')
             c.execute('UPDATE downloads SET status = ? WHERE id = ?', ('downloading', download_id))
             conn.commit()
             
             # Check if it's a YouTube URL
-            if format_type in ['mp3', 'mp4']:
+            if format_type in YTDLP_FORMATS:
                 self._download_youtube(download_id, url, filepath, format_type, conn, c)
                 return
             
@@ -162,65 +539,113 @@ class DownloadManager:
             
             total_size = int(response.headers.get('content-length', 0))
             downloaded = 0
+            last_reported = 0
+            # Hash while streaming so completed files never need to be re-read
+            hasher = hashlib.new(checksum_algo or 'sha256')
             
             c.execute('UPDATE downloads SET size = ? WHERE id = ?', (total_size, download_id))
             conn.commit()
             
             with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
+                if total_size and self._preallocate(f, total_size):
+                    # The file now owns its blocks, so free space already reflects them
+                    self.space.release(download_id)
+                
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                     if chunk:
                         f.write(chunk)
+                        hasher.update(chunk)
                         downloaded += len(chunk)
                         
-                        # Update progress every 100KB
-                        if downloaded % 102400 == 0 or downloaded == total_size:
+                        # Update progress every PROGRESS_INTERVAL bytes
+                        if downloaded - last_reported >= PROGRESS_INTERVAL or downloaded == total_size:
+                            last_reported = downloaded
                             progress = int((downloaded / total_size * 100)) if total_size > 0 else 0
                             c.execute('UPDATE downloads SET progress = ?, downloaded = ? WHERE id = ?',
                                     (progress, downloaded, download_id))
                             conn.commit()
-            
-            # Mark as completed
-            c.execute('UPDATE downloads SET status = ?, progress = 100, completed_at = ? WHERE id = ?',
-                     ('completed', datetime.now(), download_id))
+                
+                self._complete_file(c, download_id, f, filepath, downloaded, total_size,
+                                    hasher.hexdigest(), expected_checksum)
             conn.commit()
-            
+        
         except Exception as e:
-            c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
-                     ('failed', str(e), download_id))
+            self._fail_file(c, download_id, f, filepath, str(e))
             conn.commit()
         
         finally:
             conn.close()
     
+    def _complete_file(self, c, download_id, f, filepath, downloaded, total_size, digest, expected_checksum):
+        """Close a fetched file and mark it completed, or failed if its checksum doesn't match.
+        
+        Used by both transfer engines; the caller commits.
+        """
+        # Drop preallocated space the server didn't fill
+        if downloaded < total_size:
+            f.truncate(downloaded)
+        f.close()
+        
+        if expected_checksum and digest != expected_checksum:
+            os.remove(filepath)
+            self._set_stage(c, download_id, 'failed')
+            c.execute('UPDATE downloads SET status = ?, error = ?, checksum = ? WHERE id = ?',
+                     ('failed', f'Checksum mismatch: expected {expected_checksum}, got {digest}',
+                      digest, download_id))
+            return
+        
+        self._set_stage(c, download_id, 'done')
+        c.execute('''UPDATE downloads SET status = ?, progress = 100, checksum = ?, completed_at = ?
+                     WHERE id = ?''',
+                 ('completed', digest, datetime.now(), download_id))
+    
+    def _fail_file(self, c, download_id, f, filepath, error):
+        """Mark a file download failed; f is its open file, or None if it never got that far"""
+        # Don't leave a partial file behind, but never remove one this download didn't write
+        if f:
+            f.close()
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        self._set_stage(c, download_id, 'failed')
+        c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
+                 ('failed', error, download_id))
+    
+    def _set_stage(self, c, download_id, stage):
+        """Move a download to a new pipeline stage, closing the previous stage's timing"""
+        c.execute('SELECT stage, stage_timings FROM downloads WHERE id = ?', (download_id,))
+        row = c.fetchone()
+        if not row:
+            return
+        
+        now = time.time()
+        timings = json.loads(row[1]) if row[1] else {}
+        if row[0] in timings and 'seconds' not in timings[row[0]]:
+            timings[row[0]]['seconds'] = round(now - timings[row[0]]['started'], 2)
+        if stage not in ('done', 'failed'):
+            timings[stage] = {'started': now}
+        c.execute('UPDATE downloads SET stage = ?, stage_timings = ? WHERE id = ?',
+                  (stage, json.dumps(timings), download_id))
+    
     def _download_youtube(self, download_id, url, filepath, format_type, conn, c):
-        """Download YouTube video using yt-dlp"""
+        """Fetch YouTube streams with yt-dlp, then hand merging/transcoding to the post-processor.
+        
+        yt-dlp only downloads here (no -x / merge), so the download slot is
+        released as soon as the network work is done.
+        """
+        staging_dir = os.path.join(STAGING_DIR, download_id)
         try:
-            base_dir = os.path.dirname(filepath)
-            # Use video title in filename
-            output_template = os.path.join(base_dir, '%(title)s.%(ext)s')
+            os.makedirs(staging_dir, exist_ok=True)
+            output_template = os.path.join(staging_dir, '%(title)s.%(format_id)s.%(ext)s')
             
-            # Set yt-dlp options based on format
-            if format_type == 'mp3':
-                cmd = [
-                    'python3', '-m', 'yt_dlp',
-                    '-x',  # Extract audio
-                    '--audio-format', 'mp3',
-                    '--audio-quality', '0',  # Best quality
-                    '-o', output_template,
-                    '--no-playlist',
-                    '--progress',
-                    url
-                ]
-            else:  # mp4
-                cmd = [
-                    'python3', '-m', 'yt_dlp',
-                    '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-                    '--merge-output-format', 'mp4',
-                    '-o', output_template,
-                    '--no-playlist',
-                    '--progress',
-                    url
-                ]
+            cmd = [
+                'python3', '-m', 'yt_dlp',
+                '-f', YTDLP_FORMATS[format_type],
+                '-o', output_template,
+                '--no-playlist',
+                '--progress',
+                '--print', 'after_move:filepath',
+                url
+            ]
             
             # Run yt-dlp
             process = subprocess.Popen(
@@ -230,10 +655,14 @@ class DownloadManager:
                 universal_newlines=True
             )
             
-            # Monitor progress
+            # Monitor progress and collect the fetched file paths
+            fetched = []
             for line in process.stdout:
+                line = line.strip()
+                if line.startswith(staging_dir) and os.path.isfile(line):
+                    fetched.append(line)
                 # Parse progress from yt-dlp output
-                if '[download]' in line and '%' in line:
+                elif '[download]' in line and '%' in line:
                     try:
                         match = re.search(r'(\d+\.?\d*)%', line)
                         if match:
@@ -246,50 +675,102 @@ class DownloadManager:
             
             process.wait()
             
-            if process.returncode == 0:
-                # Find the most recently created file in the download directory
-                base_dir = os.path.dirname(filepath)
-                extension = format_type if format_type in ['mp3', 'mp4'] else '*'
-                
-                downloaded_file = None
-                latest_time = 0
-                
-                for file in os.listdir(base_dir):
-                    if file.endswith(f'.{extension}') or extension == '*':
-                        file_path = os.path.join(base_dir, file)
-                        file_time = os.path.getmtime(file_path)
-                        if file_time > latest_time:
-                            latest_time = file_time
-                            downloaded_file = file_path
-                
-                if downloaded_file and os.path.exists(downloaded_file):
-                    file_size = os.path.getsize(downloaded_file)
-                    c.execute('''UPDATE downloads SET status = ?, progress = 100, 
-                                size = ?, downloaded = ?, filepath = ?, 
-                                filename = ?, completed_at = ? WHERE id = ?''',
-                            ('completed', file_size, file_size, downloaded_file,
-                             os.path.basename(downloaded_file), datetime.now(), download_id))
-                else:
-                    c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
-                            ('failed', 'File not found after download', download_id))
+            if process.returncode != 0:
+                raise RuntimeError(f'yt-dlp exited with code {process.returncode}')
+            if not fetched:
+                raise RuntimeError('File not found after download')
+            
+            fetched = list(dict.fromkeys(fetched))
+            # The staged streams now count against free space on their own;
+            # keep only enough reserved for the output still to be written
+            self.space.resize(download_id, sum(os.path.getsize(p) for p in fetched))
+            title = os.path.splitext(os.path.splitext(os.path.basename(fetched[0]))[0])[0]
+            title = re.sub(r'[<>:"/\\|?*]', '', title) or f'youtube_video_{download_id}'
+            output_path = os.path.join(DOWNLOAD_DIR, f'{title}.{format_type}')
+            
+            if format_type == 'mp3':
+                job, tmp_path = audio_command(fetched[0], output_path)
+                priority = PRIORITY_TRANSCODE
+            elif len(fetched) == 1 and fetched[0].endswith('.mp4'):
+                # Already a single mp4, nothing to post-process
+                os.replace(fetched[0], output_path)
+                self._finish_youtube(download_id, output_path, staging_dir)
+                return
             else:
-                c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
-                        ('failed', f'yt-dlp exited with code {process.returncode}', download_id))
+                job, tmp_path = merge_command(fetched, output_path)
+                priority = PRIORITY_MERGE
             
+            self._set_stage(c, download_id, 'process_queued')
+            c.execute('UPDATE downloads SET status = ?, progress = 100 WHERE id = ?',
+                      ('processing', download_id))
             conn.commit()
             
+            self.postprocessor.submit(
+                job, tmp_path, output_path, priority,
+                on_start=lambda: self._update_stage(download_id, 'process'),
+                on_done=lambda future: self._finish_postprocess(download_id, future, staging_dir))
+        
+        except Exception as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            self.space.release(download_id)
+            self._set_stage(c, download_id, 'failed')
+            c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
+                     ('failed', str(e), download_id))
+            conn.commit()
+    
+    def _update_stage(self, download_id, stage):
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        self._set_stage(c, download_id, stage)
+        conn.commit()
+        conn.close()
+    
+    def _finish_postprocess(self, download_id, future, staging_dir):
+        """Called from the post-processor once a job has finished"""
+        try:
+            output_path = future.result()
         except Exception as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            self.space.release(download_id)
+            conn = sqlite3.connect(self.db)
+            c = conn.cursor()
+            self._set_stage(c, download_id, 'failed')
             c.execute('UPDATE downloads SET status = ?, error = ? WHERE id = ?',
                      ('failed', str(e), download_id))
             conn.commit()
+            conn.close()
+            return
+        
+        self._finish_youtube(download_id, output_path, staging_dir)
+    
+    def _finish_youtube(self, download_id, output_path, staging_dir):
+        """Mark a YouTube download completed and drop its intermediate files"""
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        self.space.release(download_id)
+        file_size = os.path.getsize(output_path)
+        
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        self._set_stage(c, download_id, 'done')
+        c.execute('''UPDATE downloads SET status = ?, progress = 100, 
+                    size = ?, downloaded = ?, filepath = ?, 
+                    filename = ?, completed_at = ? WHERE id = ?''',
+                ('completed', file_size, file_size, output_path,
+                 os.path.basename(output_path), datetime.now(), download_id))
+        conn.commit()
+        conn.close()
     
-    def get_downloads(self):
-        """Get all downloads"""
+    def get_downloads(self, limit=None, batch_id=None):
+        """Get downloads, newest first (all of them unless limit is given)"""
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
         c.execute('''SELECT id, url, filename, status, progress, size, downloaded, 
-                            error, format, created_at, completed_at 
-                     FROM downloads ORDER BY created_at DESC''')
+                            error, format, created_at, completed_at,
+                            checksum_algo, checksum, expected_checksum, batch_id,
+                            stage, stage_timings
+                     FROM downloads WHERE ? IS NULL OR batch_id = ?
+                     ORDER BY created_at DESC LIMIT ?''',
+                  (batch_id, batch_id, limit if limit else -1))
         rows = c.fetchall()
         conn.close()
         
@@ -306,7 +787,13 @@ class DownloadManager:
                 'error': row[7],
                 'format': row[8] if len(row) > 8 else 'auto',
                 'created_at': row[9] if len(row) > 9 else row[8],
-                'completed_at': row[10] if len(row) > 10 else row[9]
+                'completed_at': row[10] if len(row) > 10 else row[9],
+                'checksum_algo': row[11],
+                'checksum': row[12],
+                'expected_checksum': row[13],
+                'batch_id': row[14],
+                'stage': row[15],
+                'stage_timings': json.loads(row[16]) if row[16] else {}
             })
         
         return downloads
@@ -320,15 +807,34 @@ class DownloadManager:
         c.execute('SELECT filepath FROM downloads WHERE id = ?', (download_id,))
         row = c.fetchone()
         
-        if row and os.path.exists(row[0]):
+        if row and row[0] and os.path.exists(row[0]):
             os.remove(row[0])
         
         c.execute('DELETE FROM downloads WHERE id = ?', (download_id,))
         conn.commit()
         conn.close()
+        
+        with self._path_cache_lock:
+            self._path_cache.pop(download_id, None)
+    
+    def forget_paths(self, download_ids):
+        """Drop cached file paths, e.g. for rows expired by retention"""
+        with self._path_cache_lock:
+            for download_id in download_ids:
+                self._path_cache.pop(download_id, None)
     
     def get_download_path(self, download_id):
         """Get file path for download"""
+        with self._path_cache_lock:
+            filepath = self._path_cache.get(download_id)
+            if filepath:
+                self._path_cache.move_to_end(download_id)
+        if filepath:
+            if os.path.exists(filepath):
+                return filepath
+            with self._path_cache_lock:
+                self._path_cache.pop(download_id, None)
+        
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
         c.execute('SELECT filepath, status FROM downloads WHERE id = ?', (download_id,))
@@ -336,5 +842,9 @@ class DownloadManager:
         conn.close()
         
         if row and row[1] == 'completed' and os.path.exists(row[0]):
+            with self._path_cache_lock:
+                self._path_cache[download_id] = row[0]
+                if len(self._path_cache) > PATH_CACHE_SIZE:
+                    self._path_cache.popitem(last=False)
             return row[0]
         return None
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Range-capable, conditional file responses for completed downloads"""
+
+import os
+import re
+import mimetypes
+from urllib.parse import quote
+from flask import Response, request
+from werkzeug.http import http_date, parse_date
+
+CHUNK_SIZE = 256 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def make_etag(st):
+    """Strong ETag from inode, size and mtime - changes whenever the file does"""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def _etag_matches(header, etag):
+    """Strong comparison against an If-None-Match / If-Range style header"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in header.split(',')]
+
+def _parse_range(header, size):
+    """Parse a single byte range, returns (start, end) inclusive, None to ignore, or False if unsatisfiable"""
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match:
+        return None  # multiple or malformed ranges: serve the whole file
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    
+    if not first:
+        # Suffix range: the final N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+def _read_range(f, start, length):
+    """Fallback body for servers without wsgi.file_wrapper"""
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def serve_file(path, download_name=None):
+    """Serve a file with Range, If-Range, ETag, Last-Modified and HEAD support.
+    
+    When the WSGI server offers wsgi.file_wrapper (e.g. gunicorn) and the
+    response runs to the end of the file, the file is handed over positioned
+    at the range start so the server can use os.sendfile. Bounded ranges are
+    streamed in chunks since not every file_wrapper stops at Content-Length.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    etag = make_etag(st)
+    last_modified = http_date(st.st_mtime)
+    download_name = download_name or os.path.basename(path)
+    
+    headers = {
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, no-cache',
+    }
+    
+    # Conditional GET: If-None-Match wins over If-Modified-Since
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        if _etag_matches(if_none_match, etag):
+            return Response(status=304, headers=headers)
+    else:
+        since = parse_date(request.headers.get('If-Modified-Since'))
+        if since and int(st.st_mtime) <= since.timestamp():
+            return Response(status=304, headers=headers)
+    
+    start, end = 0, size - 1
+    status = 200
+    range_header = request.headers.get('Range')
+    if range_header and size > 0:
+        # If-Range: only honour the range when the client's copy is still current
+        if_range = request.headers.get('If-Range')
+        honour = True
+        if if_range:
+            if if_range.startswith('"'):
+                honour = if_range.strip() == etag
+            else:
+                honour = if_range.strip() == last_modified
+        
+        byte_range = _parse_range(range_header, size) if honour else None
+        if byte_range is False:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    
+    length = max(end - start + 1, 0)
+    headers['Content-Length'] = str(length)
+    headers['Content-Disposition'] = (
+        "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(
+            download_name.encode('ascii', 'replace').decode().replace('"', ''),
+            quote(download_name)))
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    
+    if request.method == 'HEAD':
+        return Response(status=status, headers=headers, mimetype=mimetype)
+    
+    f = open(path, 'rb')
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper and end == size - 1:
+        f.seek(start)
+        body = file_wrapper(f, CHUNK_SIZE)
+    else:
+        body = _read_range(f, start, length)
+    
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Post-processing Stage - merging and transcoding in a bounded process pool"""
+
+import os
+import itertools
+import queue
+import subprocess
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+MAX_POSTPROCESS_WORKERS = 1  # every extra ffmpeg heats the phone up further
+POSTPROCESS_NICE = 10        # keep the dashboard and network stage responsive
+FFMPEG_THREADS = 2
+
+# Lower runs first: stream-copy merges are cheap, mp3 encodes are not
+PRIORITY_MERGE = 0
+PRIORITY_TRANSCODE = 1
+
+def _lower_priority():
+    """Worker initializer: ffmpeg children inherit the niceness"""
+    try:
+        os.nice(POSTPROCESS_NICE)
+    except OSError:
+        pass
+
+def _run_job(cmd, tmp_path, output_path):
+    """Run one ffmpeg command in a pool worker, then move the result into place"""
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        error = result.stderr.strip().splitlines()
+        raise RuntimeError(f'ffmpeg exited with code {result.returncode}: {error[-1] if error else ""}')
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def merge_command(inputs, output_path):
+    """Stream-copy video (+ audio) into an mp4 container"""
+    tmp_path = output_path + '.part'
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-threads', str(FFMPEG_THREADS)]
+    for path in inputs:
+        cmd += ['-i', path]
+    if len(inputs) > 1:
+        cmd += ['-map', '0:v:0', '-map', '1:a:0']
+    cmd += ['-c', 'copy', '-f', 'mp4', tmp_path]
+    return cmd, tmp_path
+
+def audio_command(input_path, output_path):
+    """Encode the audio track to VBR mp3 (same quality as yt-dlp --audio-quality 0)"""
+    tmp_path = output_path + '.part'
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-threads', str(FFMPEG_THREADS),
+           '-i', input_path, '-vn', '-codec:a', 'libmp3lame', '-q:a', '0', '-f', 'mp3', tmp_path]
+    return cmd, tmp_path
+
+class PostProcessor:
+    """Runs CPU-heavy jobs one priority queue at a time on a small process pool.
+    
+    Jobs are only handed to the pool when a worker is free, so the queue
+    order (priority, then arrival) is what decides what runs next.
+    """
+    
+    def __init__(self, workers=MAX_POSTPROCESS_WORKERS):
+        self.workers = workers
+        self._queue = queue.PriorityQueue()
+        self._free = threading.Semaphore(workers)
+        self._seq = itertools.count()
+        self._pool = None
+        dispatcher = threading.Thread(target=self._dispatch, name='postprocess-dispatcher')
+        dispatcher.daemon = True
+        dispatcher.start()
+    
+    def submit(self, cmd, tmp_path, output_path, priority, on_start, on_done):
+        """Queue a job; on_start() runs when it reaches a worker, on_done(future) when it finishes"""
+        self._queue.put((priority, next(self._seq), (cmd, tmp_path, output_path, on_start, on_done)))
+    
+    def _dispatch(self):
+        while True:
+            self._free.acquire()
+            _, _, (cmd, tmp_path, output_path, on_start, on_done) = self._queue.get()
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_lower_priority)
+            
+            try:
+                on_start()
+            except Exception:
+                pass
+            
+            def finished(f, on_done=on_done):
+                if isinstance(f.exception(), BrokenProcessPool):
+                    self._discard_pool()
+                self._free.release()
+                try:
+                    on_done(f)
+                except Exception:
+                    pass
+            
+            try:
+                future = self._pool.submit(_run_job, cmd, tmp_path, output_path)
+            except Exception as e:
+                # A killed worker (Android does this) breaks the whole pool; start a new one next time
+                if isinstance(e, BrokenProcessPool):
+                    self._discard_pool()
+                future = Future()
+                future.set_exception(e)
+            future.add_done_callback(finished)
+    
+    def _discard_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Sampling Profiler and Slow Request Log"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+# Sampling defaults
+SAMPLE_INTERVAL = 0.01  # seconds between samples (~100 Hz)
+MAX_PROFILE_SECONDS = 60
+SLOW_LOG_SIZE = 200
+
+
+def _frame_label(frame):
+    """Format a frame as 'function (file:line)'"""
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _frame_stack(frame):
+    """Walk a frame back to its root, returning labels outermost first"""
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class SamplingProfiler:
+    """Periodically samples the stacks of every thread in the process.
+
+    Only one profile runs at a time; the sampler never instruments code so
+    the overhead is a stack walk per thread per interval.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def profile(self, seconds):
+        """Sample all threads for `seconds`, returns (Counter of stacks, samples taken).
+
+        Returns None if another profile is already running.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+            me = threading.get_ident()
+            names = {}
+            counts = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+
+            while time.monotonic() < deadline:
+                frames = sys._current_frames()
+                if any(tid not in names for tid in frames):
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                for tid, frame in frames.items():
+                    if tid == me:
+                        continue
+                    thread_name = names.get(tid, f'thread-{tid}')
+                    counts[';'.join([thread_name] + _frame_stack(frame))] += 1
+                samples += 1
+                time.sleep(self.interval)
+
+            return counts, samples
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapse(counts):
+        """Render stacks in the collapsed format read by flamegraph.pl / speedscope"""
+        return '\n'.join(f'{stack} {count}' for stack, count in counts.most_common()) + '\n'
+
+
+class SlowRequestLog:
+    """Records requests slower than a threshold along with a stack sample.
+
+    A watchdog thread samples the handling thread's stack once the request
+    has been running longer than the threshold, so the sample shows where
+    the slow request was actually stuck rather than where it finished.
+    """
+
+    def __init__(self, threshold_ms, size=SLOW_LOG_SIZE, logger=None):
+        self.threshold = threshold_ms / 1000.0
+        self.entries = deque(maxlen=size)
+        self.logger = logger
+        self._active = {}
+        self._lock = threading.Lock()
+        self._watchdog = threading.Thread(target=self._watch, name='slow-request-watchdog')
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def start(self, route):
+        """Mark the current thread as handling `route`"""
+        with self._lock:
+            self._active[threading.get_ident()] = {'route': route, 'start': time.monotonic(), 'stack': None}
+
+    def finish(self):
+        """Close the current thread's request, logging it if it was slow"""
+        with self._lock:
+            info = self._active.pop(threading.get_ident(), None)
+        if not info:
+            return
+
+        duration = time.monotonic() - info['start']
+        if duration < self.threshold:
+            return
+
+        entry = {
+            'route': info['route'],
+            'duration_ms': round(duration * 1000, 1),
+            'timestamp': datetime.now().isoformat(),
+            'stack': info['stack'] or [],
+        }
+        self.entries.append(entry)
+        if self.logger:
+            self.logger.warning('Slow request %s took %.1f ms', entry['route'], entry['duration_ms'])
+
+    def get_entries(self):
+        """Get logged slow requests, newest first"""
+        return list(reversed(self.entries))
+
+    def _watch(self):
+        """Capture a stack sample for every request that crosses the threshold"""
+        interval = max(self.threshold / 2, 0.05)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                pending = [tid for tid, info in self._active.items()
+                           if info['stack'] is None and now - info['start'] >= self.threshold]
+            if not pending:
+                continue
+
+            frames = sys._current_frames()
+            with self._lock:
+                for tid in pending:
+                    info = self._active.get(tid)
+                    if info and tid in frames:
+                        info['stack'] = _frame_stack(frames[tid])
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Service Logs - size-capped capture, tailing and live follow"""
+
+import os
+import glob
+import shutil
+import threading
+from collections import deque
+
+LOG_DIR = os.path.expanduser("~/.vps-on-phone/logs")
+LOG_MAX_BYTES = 1024 * 1024   # rotate once a log grows past this
+LOG_BACKUPS = 2               # <sid>.log.1 ... <sid>.log.N
+MAX_TAIL_LINES = 1000
+FOLLOW_BUFFER_LINES = 500     # recent lines kept per followed log, shared by all followers
+POLL_INTERVAL = 0.2           # while someone is following
+IDLE_INTERVAL = 5             # rotation checks only
+KEEPALIVE_SECONDS = 15
+TAIL_BLOCK_SIZE = 8192
+
+os.makedirs(LOG_DIR, exist_ok=True)
+
+def log_path(sid):
+    return os.path.join(LOG_DIR, f'{sid}.log')
+
+def open_log(sid):
+    """Append-mode log file to hand to a child process as stdout/stderr"""
+    return open(log_path(sid), 'ab')
+
+def tail_file(path, lines):
+    """Last `lines` lines of a file, reading backwards from the end block by block"""
+    if lines <= 0 or not os.path.exists(path):
+        return []
+    
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        while pos > 0 and data.count(b'\n') <= lines:
+            step = min(TAIL_BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    
+    return [line.decode('utf-8', 'replace') for line in data.splitlines()[-lines:]]
+
+def tail(sid, lines):
+    """Last lines of a service log, continuing into the rotated file if needed"""
+    lines = max(1, min(lines, MAX_TAIL_LINES))
+    result = tail_file(log_path(sid), lines)
+    if len(result) < lines:
+        result = tail_file(log_path(sid) + '.1', lines - len(result)) + result
+    return result
+
+class LogWatcher:
+    """One thread that rotates every service log and feeds all followers.
+    
+    Children write to their log with O_APPEND, so rotation copies the file
+    aside and truncates it in place (like logrotate's copytruncate). Each
+    followed log is read once per poll and the new lines go into a shared
+    ring buffer that every follower reads from.
+    """
+    
+    def __init__(self):
+        self._channels = {}
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        thread = threading.Thread(target=self._watch, name='service-log-watcher')
+        thread.daemon = True
+        thread.start()
+    
+    def _rotate(self, path):
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f'{path}.{i}'):
+                os.replace(f'{path}.{i}', f'{path}.{i + 1}')
+        shutil.copyfile(path, f'{path}.1')
+        with open(path, 'r+b') as f:
+            f.truncate(0)
+    
+    def _read_new(self, path, channel):
+        """Read what was appended since the last poll into the channel's buffer"""
+        size = os.path.getsize(path)
+        if size < channel['offset']:
+            channel['offset'] = 0  # truncated by rotation
+        if size == channel['offset']:
+            return
+        
+        with open(path, 'rb') as f:
+            f.seek(channel['offset'])
+            data = f.read(size - channel['offset'])
+        channel['offset'] += len(data)
+        
+        *complete, channel['partial'] = (channel['partial'] + data).split(b'\n')
+        if complete:
+            with self._cond:
+                for line in complete:
+                    channel['seq'] += 1
+                    channel['lines'].append((channel['seq'], line.decode('utf-8', 'replace')))
+                self._cond.notify_all()
+    
+    def _watch(self):
+        while True:
+            for path in glob.glob(os.path.join(LOG_DIR, '*.log')):
+                try:
+                    with self._cond:
+                        channel = self._channels.get(path)
+                    if channel:
+                        self._read_new(path, channel)
+                    if os.path.getsize(path) > LOG_MAX_BYTES:
+                        self._rotate(path)
+                except OSError:
+                    pass
+            
+            self._wake.wait(POLL_INTERVAL if self._channels else IDLE_INTERVAL)
+            self._wake.clear()
+    
+    def follow(self, sid):
+        """Subscribe to a service log now. Iterating the returned follower yields
+        lists of new lines as they are written ([] as a periodic keepalive);
+        call unsubscribe() when done."""
+        path = log_path(sid)
+        with self._cond:
+            channel = self._channels.get(path)
+            if channel is None:
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+                channel = {'offset': offset, 'partial': b'', 'seq': 0, 'followers': 0,
+                           'lines': deque(maxlen=FOLLOW_BUFFER_LINES)}
+                self._channels[path] = channel
+            channel['followers'] += 1
+            seq = channel['seq']
+        self._wake.set()
+        return _Follower(self, path, channel, seq)
+    
+    def _unsubscribe(self, path, channel):
+        with self._cond:
+            channel['followers'] -= 1
+            if channel['followers'] == 0:
+                self._channels.pop(path, None)
+
+class _Follower:
+    """One subscriber to a followed log.
+    
+    Unsubscribing is explicit rather than left to a generator's finally,
+    which never runs if the generator is closed before it starts.
+    """
+    
+    def __init__(self, watcher, path, channel, seq):
+        self._watcher = watcher
+        self._path = path
+        self._channel = channel
+        self._seq = seq
+        self._subscribed = True
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        if not self._subscribed:
+            raise StopIteration
+        channel = self._channel
+        with self._watcher._cond:
+            self._watcher._cond.wait_for(lambda: channel['seq'] > self._seq, timeout=KEEPALIVE_SECONDS)
+            # Followers that fall more than a buffer behind skip ahead
+            new = [line for n, line in channel['lines'] if n > self._seq]
+            self._seq = channel['seq']
+        return new
+    
+    def unsubscribe(self):
+        """Stop following (safe to call more than once)"""
+        if self._subscribed:
+            self._subscribed = False
+            self._watcher._unsubscribe(self._path, self._channel)
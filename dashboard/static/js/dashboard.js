@@ -528,7 +528,7 @@ async function loadDownloads() {
         displayDownloads(downloads);
         
         // Auto-refresh if there are active downloads
-        const hasActive = downloads.some(d => d.status === 'downloading' || d.status === 'queued');
+        const hasActive = downloads.some(d => ['resolving', 'queued', 'downloading', 'processing'].includes(d.status));
         
         if (hasActive && !downloadInterval) {
             downloadInterval = setInterval(loadDownloads, 5000); // 5 seconds for active downloads
@@ -556,15 +556,19 @@ function displayDownloads(downloads) {
     
     downloadsList.innerHTML = downloads.map(download => {
         const statusColors = {
+            resolving: '#9ca3af',
             queued: '#6b7280',
             downloading: '#3b82f6',
+            processing: '#8b5cf6',
             completed: '#10b981',
             failed: '#ef4444'
         };
         
         const statusLabels = {
+            resolving: 'Resolving',
             queued: 'Queued',
             downloading: 'Downloading',
+            processing: 'Processing',
             completed: 'Completed',
             failed: 'Failed'
         };
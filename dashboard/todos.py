@@ -2,22 +2,69 @@
 """Todo App Backend"""
 
 import os
+import heapq
+import itertools
 import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 DB_PATH = os.path.expanduser("~/.vps-on-phone/todos.db")
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
+CACHE_SIZE = 128
+TODOS_PER_PAGE = 50
+REMINDER_RECHECK = 60   # re-read the clock at least this often (phones sleep, clocks jump)
+UPCOMING_LIMIT = 20
+
+def parse_due(due_date):
+    """Due date string -> timestamp, or None if unset/unparseable.
+    
+    Accepts ISO dates and datetimes; a bare date is due at the end of that day.
+    """
+    if not due_date:
+        return None
+    try:
+        due = datetime.fromisoformat(str(due_date).strip())
+    except ValueError:
+        return None
+    if len(str(due_date).strip()) == 10:
+        due += timedelta(days=1)
+    return due.timestamp()
+
 class TodoManager:
     def __init__(self):
         self.db = DB_PATH
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_coalesced = 0
+        
+        # Due-date scheduler: open todos with a due date, pending ones in a min-heap
+        self._due_entries = {}         # todo_id -> entry
+        self._due_heap = []            # (due, seq, entry), stale entries skipped lazily
+        self._due_stale = 0
+        self._overdue = OrderedDict()  # todo_id -> entry, roughly in due order
+        self._due_seq = itertools.count()
+        self._due_cond = threading.Condition()
+        self._reminder_listeners = []
+        
         self.init_db()
+        self._load_due()
+        thread = threading.Thread(target=self._remind_loop, name='todo-reminders')
+        thread.daemon = True
+        thread.start()
     
     def init_db(self):
         """Initialize database"""
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
+        # WAL lets readers and online backups run alongside writers
+        c.execute('PRAGMA journal_mode = WAL')
         c.execute('''CREATE TABLE IF NOT EXISTS todos
                      (id TEXT PRIMARY KEY,
                       title TEXT NOT NULL,
@@ -30,6 +77,10 @@ class TodoManager:
                       completed_at TIMESTAMP,
                       position INTEGER)''')
         
+        # Only open todos with a due date, so the scheduler loads without a table scan
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_todos_due ON todos(due_date)
+                     WHERE completed = 0 AND due_date IS NOT NULL''')
+        
         c.execute('''CREATE TABLE IF NOT EXISTS categories
                      (id TEXT PRIMARY KEY,
                       name TEXT UNIQUE,
@@ -50,6 +101,218 @@ class TodoManager:
         conn.commit()
         conn.close()
     
+    def _cached(self, key, loader):
+        """Read-through LRU cache; concurrent misses on a key share a single query.
+        
+        Only writes made through this TodoManager invalidate entries, so changes
+        made behind its back (e.g. cleanup.py) show up after a dashboard restart.
+        """
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._cache_hits += 1
+                return self._cache[key]
+            
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = {'event': threading.Event(), 'value': None, 'error': None, 'stale': False}
+                self._pending[key] = pending
+                self._cache_misses += 1
+            else:
+                self._cache_coalesced += 1
+        
+        if not leader:
+            pending['event'].wait()
+            if pending['error']:
+                raise pending['error']
+            return pending['value']
+        
+        try:
+            pending['value'] = loader()
+        except Exception as e:
+            pending['error'] = e
+            raise
+        finally:
+            with self._cache_lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+                # A write that landed mid-query makes the result unsafe to keep
+                if pending['error'] is None and not pending['stale']:
+                    self._cache[key] = pending['value']
+                    if len(self._cache) > CACHE_SIZE:
+                        self._cache.popitem(last=False)
+            pending['event'].set()
+        return pending['value']
+    
+    def _invalidate(self, categories, filters=('all', 'active', 'completed')):
+        """Drop cached todo lists for the given categories/filters, plus the stats"""
+        def affected(key):
+            if key[0] == 'stats':
+                return True
+            return key[0] == 'todos' and key[1] in filters and (key[2] is None or key[2] in categories)
+        
+        with self._cache_lock:
+            for key in [key for key in self._cache if affected(key)]:
+                del self._cache[key]
+            for key in [key for key in self._pending if affected(key)]:
+                self._pending.pop(key)['stale'] = True
+    
+    def _get_state(self, c, todo_id):
+        """Get (category, completed) for a todo, used to scope invalidation"""
+        c.execute('SELECT category, completed FROM todos WHERE id = ?', (todo_id,))
+        return c.fetchone()
+    
+    def get_cache_stats(self):
+        """Get cache size and hit ratio"""
+        with self._cache_lock:
+            lookups = self._cache_hits + self._cache_misses + self._cache_coalesced
+            return {
+                'size': len(self._cache),
+                'max_size': CACHE_SIZE,
+                'hits': self._cache_hits,
+                'misses': self._cache_misses,
+                'coalesced': self._cache_coalesced,
+                'hit_ratio': round((self._cache_hits + self._cache_coalesced) / lookups, 3) if lookups else 0.0
+            }
+    
+    def _load_due(self):
+        """Fill the heap from the partial due_date index; already overdue todos don't fire"""
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        c.execute('''SELECT id, title, due_date FROM todos
+                     WHERE completed = 0 AND due_date IS NOT NULL ORDER BY due_date''')
+        rows = c.fetchall()
+        conn.close()
+        
+        now = time.time()
+        with self._due_cond:
+            for todo_id, title, due_date in rows:
+                due = parse_due(due_date)
+                if due is None:
+                    continue
+                entry = {'id': todo_id, 'title': title, 'due_date': due_date, 'due': due, 'fired': due <= now}
+                self._due_entries[todo_id] = entry
+                if entry['fired']:
+                    self._overdue[todo_id] = entry
+                else:
+                    self._due_heap.append((due, next(self._due_seq), entry))
+            heapq.heapify(self._due_heap)
+    
+    def _track(self, todo_id, title, due_date, completed):
+        """Bring the scheduler in line with a todo's current title, due date and status"""
+        due = None if completed else parse_due(due_date)
+        with self._due_cond:
+            old = self._due_entries.get(todo_id)
+            if old and due == old['due']:
+                old['title'] = title  # same deadline: no need to reschedule or re-fire
+                return
+            self._untrack_locked(todo_id)
+            if due is None:
+                return
+            
+            entry = {'id': todo_id, 'title': title, 'due_date': due_date, 'due': due, 'fired': False}
+            self._due_entries[todo_id] = entry
+            heapq.heappush(self._due_heap, (due, next(self._due_seq), entry))
+            if self._due_heap[0][2] is entry:
+                self._due_cond.notify()  # new earliest deadline: wake the reminder thread
+    
+    def _untrack_locked(self, todo_id):
+        entry = self._due_entries.pop(todo_id, None)
+        if entry is None:
+            return
+        if entry['fired']:
+            del self._overdue[todo_id]
+            return
+        
+        # Leave it in the heap and skip it later; rebuild once half the heap is dead
+        self._due_stale += 1
+        if self._due_stale > len(self._due_heap) // 2:
+            self._due_heap = [item for item in self._due_heap if self._due_entries.get(item[2]['id']) is item[2]]
+            heapq.heapify(self._due_heap)
+            self._due_stale = 0
+    
+    def _is_live(self, item):
+        return self._due_entries.get(item[2]['id']) is item[2]
+    
+    def _remind_loop(self):
+        """Sleep until the earliest deadline, then move due todos to overdue and fire reminders"""
+        while True:
+            fired = []
+            with self._due_cond:
+                now = time.time()
+                while self._due_heap and self._due_heap[0][0] <= now:
+                    item = heapq.heappop(self._due_heap)
+                    if not self._is_live(item):
+                        self._due_stale -= 1
+                        continue
+                    item[2]['fired'] = True
+                    self._overdue[item[2]['id']] = item[2]
+                    fired.append(self._describe_due(item[2], now))
+                
+                if not fired:
+                    timeout = REMINDER_RECHECK
+                    if self._due_heap:
+                        timeout = min(self._due_heap[0][0] - now, REMINDER_RECHECK)
+                    self._due_cond.wait(timeout)
+                    continue
+            
+            for event in fired:
+                for listener in list(self._reminder_listeners):
+                    try:
+                        listener(event)
+                    except Exception:
+                        pass
+    
+    def on_reminder(self, callback):
+        """Register callback(event) to run when a todo becomes due"""
+        self._reminder_listeners.append(callback)
+    
+    def _describe_due(self, entry, now):
+        return {
+            'id': entry['id'],
+            'title': entry['title'],
+            'due_date': entry['due_date'],
+            'due_in': round(entry['due'] - now)
+        }
+    
+    def get_overdue(self):
+        """Open todos past their due date, most overdue first.
+        
+        Reads the overdue set the reminder thread maintains, so the cost is
+        the number of overdue todos. It's appended in due order almost always,
+        which keeps the sort linear.
+        """
+        now = time.time()
+        with self._due_cond:
+            entries = sorted(self._overdue.values(), key=lambda entry: entry['due'])
+            return [self._describe_due(entry, now) for entry in entries]
+    
+    def get_upcoming(self, limit=UPCOMING_LIMIT, within=None):
+        """Next `limit` deadlines (optionally only those due within `within` seconds).
+        
+        Walks the heap best-first with a small frontier heap, so only about
+        `limit` nodes are visited instead of sorting everything pending.
+        """
+        now = time.time()
+        limit = max(1, min(limit or UPCOMING_LIMIT, 500))
+        until = now + within if within is not None else None
+        
+        upcoming = []
+        with self._due_cond:
+            heap = self._due_heap
+            frontier = [(heap[0], 0)] if heap else []
+            while frontier and len(upcoming) < limit:
+                item, i = heapq.heappop(frontier)
+                if until is not None and item[0] > until:
+                    break
+                if self._is_live(item):
+                    upcoming.append(self._describe_due(item[2], now))
+                for child in (2 * i + 1, 2 * i + 2):
+                    if child < len(heap):
+                        heapq.heappush(frontier, (heap[child], child))
+        return upcoming
+    
     def add_todo(self, title, description='', priority='medium', category='other', due_date=None):
         """Add a new todo"""
         todo_id = str(uuid.uuid4())[:8]
@@ -69,31 +332,47 @@ class TodoManager:
         conn.commit()
         conn.close()
         
+        self._invalidate({category}, filters=('all', 'active'))
+        self._track(todo_id, title, due_date, False)
+        
         return todo_id
     
-    def get_todos(self, filter_by='all'):
-        """Get todos with optional filter"""
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-        
+    def get_todos(self, filter_by='all', category=None, page=None, per_page=TODOS_PER_PAGE):
+        """Get todos with optional filter, category and page (1-based; all rows if None)"""
+        if filter_by not in ('active', 'completed'):
+            filter_by = 'all'
+        if page is not None:
+            page = max(page, 1)
+            per_page = max(1, min(per_page or TODOS_PER_PAGE, 500))
+        key = ('todos', filter_by, category, page, per_page if page else None)
+        return self._cached(key, lambda: self._query_todos(filter_by, category, page, per_page))
+    
+    def _query_todos(self, filter_by, category, page, per_page):
         if filter_by == 'active':
-            c.execute('''SELECT t.*, cat.name as category_name, cat.color as category_color, cat.icon as category_icon
-                        FROM todos t 
-                        LEFT JOIN categories cat ON t.category = cat.id
-                        WHERE t.completed = 0 
-                        ORDER BY t.position, t.created_at DESC''')
+            where, order = ['t.completed = 0'], 't.position, t.created_at DESC'
         elif filter_by == 'completed':
-            c.execute('''SELECT t.*, cat.name as category_name, cat.color as category_color, cat.icon as category_icon
-                        FROM todos t 
-                        LEFT JOIN categories cat ON t.category = cat.id
-                        WHERE t.completed = 1 
-                        ORDER BY t.completed_at DESC''')
+            where, order = ['t.completed = 1'], 't.completed_at DESC'
         else:  # all
-            c.execute('''SELECT t.*, cat.name as category_name, cat.color as category_color, cat.icon as category_icon
-                        FROM todos t 
-                        LEFT JOIN categories cat ON t.category = cat.id
-                        ORDER BY t.completed, t.position, t.created_at DESC''')
+            where, order = [], 't.completed, t.position, t.created_at DESC'
+        
+        params = []
+        if category:
+            where.append('t.category = ?')
+            params.append(category)
+        
+        query = '''SELECT t.*, cat.name as category_name, cat.color as category_color, cat.icon as category_icon
+                   FROM todos t 
+                   LEFT JOIN categories cat ON t.category = cat.id'''
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY ' + order
+        if page:
+            query += ' LIMIT ? OFFSET ?'
+            params += [per_page, (page - 1) * per_page]
         
+        conn = sqlite3.connect(self.db)
+        c = conn.cursor()
+        c.execute(query, params)
         rows = c.fetchall()
         conn.close()
         
@@ -132,10 +411,24 @@ class TodoManager:
                 values.append(value)
         
         if updates:
+            state = self._get_state(c, todo_id)
             values.append(todo_id)
             query = f"UPDATE todos SET {', '.join(updates)} WHERE id = ?"
             c.execute(query, values)
             conn.commit()
+            
+            if state:
+                categories = {state[0], kwargs.get('category', state[0])}
+                if 'completed' in kwargs:
+                    self._invalidate(categories)
+                else:
+                    self._invalidate(categories, filters=('all', 'completed' if state[1] else 'active'))
+            
+            if {'title', 'due_date', 'completed'} & kwargs.keys():
+                c.execute('SELECT title, due_date, completed FROM todos WHERE id = ?', (todo_id,))
+                row = c.fetchone()
+                if row:
+                    self._track(todo_id, *row)
         
         conn.close()
     
@@ -144,7 +437,7 @@ class TodoManager:
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
         
-        c.execute('SELECT completed FROM todos WHERE id = ?', (todo_id,))
+        c.execute('SELECT completed, title, due_date FROM todos WHERE id = ?', (todo_id,))
         row = c.fetchone()
         
         if row:
@@ -153,6 +446,8 @@ class TodoManager:
             c.execute('UPDATE todos SET completed = ?, completed_at = ? WHERE id = ?',
                      (new_status, completed_at, todo_id))
             conn.commit()
+            self._invalidate({self._get_state(c, todo_id)[0]})
+            self._track(todo_id, row[1], row[2], new_status)
         
         conn.close()
     
@@ -160,12 +455,21 @@ class TodoManager:
         """Delete a todo"""
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
+        state = self._get_state(c, todo_id)
         c.execute('DELETE FROM todos WHERE id = ?', (todo_id,))
         conn.commit()
         conn.close()
+        
+        if state:
+            self._invalidate({state[0]}, filters=('all', 'completed' if state[1] else 'active'))
+        with self._due_cond:
+            self._untrack_locked(todo_id)
     
     def get_categories(self):
         """Get all categories"""
+        return self._cached(('categories',), self._query_categories)
+    
+    def _query_categories(self):
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
         c.execute('SELECT id, name, color, icon FROM categories')
@@ -185,6 +489,9 @@ class TodoManager:
     
     def get_stats(self):
         """Get todo statistics"""
+        return self._cached(('stats',), self._query_stats)
+    
+    def _query_stats(self):
         conn = sqlite3.connect(self.db)
         c = conn.cursor()
         
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""Async Transfer Engine - every plain HTTP(S) download on one event loop"""
+
+import asyncio
+import hashlib
+import sqlite3
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
+
+MAX_TRANSFERS = 64          # in flight at once; each costs a buffer or two, not a thread
+BUFFER_SIZE = 64 * 1024     # receive buffer, also the size of each file write
+POOL_KEEP = 16              # idle buffers kept for reuse after a burst
+IO_WORKERS = 2              # file writes, hashing and SQLite updates
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 30
+MAX_REDIRECTS = 10
+SPACE_POLL_SECONDS = 5
+PROGRESS_INTERVAL = 512 * 1024
+USER_AGENT = 'vps-on-phone'
+
+def _ssl_context():
+    """Verify against the same CA bundle requests uses"""
+    try:
+        import certifi
+        return ssl.create_default_context(cafile=certifi.where())
+    except ImportError:
+        return ssl.create_default_context()
+
+def _parse_head(head):
+    """Status line and headers -> (status, reason, {lowercase name: value})"""
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ValueError(f'Invalid HTTP response: {lines[0][:80]}')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return int(parts[1]), parts[2] if len(parts) > 2 else '', headers
+
+def _write(f, hasher, segments):
+    """Write and hash body segments in order (runs on an IO worker)"""
+    written = 0
+    for segment in segments:
+        while segment:
+            n = f.write(segment)
+            hasher.update(segment[:n])
+            segment = segment[n:]
+            written += n
+    return written
+
+class BufferPool:
+    """Receive buffers shared by every transfer; only used from the event loop thread"""
+    
+    def __init__(self, size=BUFFER_SIZE, keep=POOL_KEEP):
+        self.size = size
+        self.keep = keep
+        self._free = []
+    
+    def get(self):
+        return self._free.pop() if self._free else bytearray(self.size)
+    
+    def put(self, buf):
+        if len(self._free) < self.keep:
+            self._free.append(buf)
+
+class _Connection(asyncio.BufferedProtocol):
+    """Receives straight into a pooled buffer.
+    
+    Reading pauses once the buffer is full; the consumer swaps it for an
+    empty one and hands the full one to an IO worker, so the network keeps
+    filling the next buffer while the previous one is written.
+    """
+    
+    def __init__(self, pool):
+        self.pool = pool
+        self.buf = pool.get()
+        self.filled = 0
+        self.eof = False
+        self.error = None
+        self.transport = None
+        self._want = 1
+        self._waiter = None
+        self._paused = False
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def get_buffer(self, sizehint):
+        return memoryview(self.buf)[self.filled:]
+    
+    def buffer_updated(self, nbytes):
+        self.filled += nbytes
+        if self.filled == len(self.buf) and not self._paused:
+            self._paused = True
+            self.transport.pause_reading()
+        if self.filled >= self._want:
+            self._wake()
+    
+    def eof_received(self):
+        self.eof = True
+        self._wake()
+        return False
+    
+    def connection_lost(self, exc):
+        self.eof = True
+        self.error = exc
+        self._wake()
+    
+    def _wake(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+    
+    async def _wait(self, want):
+        """Wait until at least `want` bytes are buffered or the stream ends"""
+        while self.filled < want and not self.eof:
+            self._want = want
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self._waiter, READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f'No data received for {READ_TIMEOUT} seconds') from None
+            finally:
+                self._waiter = None
+        if self.error:
+            raise self.error
+    
+    async def read_head(self):
+        """Wait for the status line and headers, returns (head, offset of the body in the buffer)"""
+        while True:
+            end = self.buf.find(b'\r\n\r\n', 0, self.filled)
+            if end >= 0:
+                return bytes(self.buf[:end]), end + 4
+            if self.eof:
+                raise ConnectionError('Connection closed before the response headers')
+            if self.filled == len(self.buf):
+                raise ValueError('Response headers too large')
+            await self._wait(self.filled + 1)
+    
+    async def take(self, expected=None):
+        """Wait for a full buffer (or the end of the stream / the body) and swap it out.
+        
+        Returns (buffer, nbytes); the caller gives the buffer back to the pool.
+        """
+        want = len(self.buf)
+        if expected is not None:
+            want = min(want, max(expected, 1))
+        await self._wait(want)
+        return self.swap()
+    
+    def swap(self):
+        """Hand over the current buffer as-is and carry on reading into a fresh one"""
+        buf, nbytes = self.buf, self.filled
+        self.buf, self.filled = self.pool.get(), 0
+        if self._paused and not self.eof:
+            self._paused = False
+            self.transport.resume_reading()
+        return buf, nbytes
+    
+    def close(self):
+        """Close the connection and return the current buffer to the pool"""
+        if self.transport:
+            self.transport.close()
+        self.pool.put(self.buf)
+        # Anything still delivered after close is discarded into a private scratch buffer
+        self.buf, self.filled = bytearray(4096), 0
+        self.buffer_updated = lambda nbytes: None
+
+class _LengthBody:
+    """Body delimited by Content-Length, or by the connection closing if length is None"""
+    
+    def __init__(self, length):
+        self.remaining = length
+        self.done = length == 0
+    
+    def feed(self, buf, start, end):
+        if self.remaining is not None:
+            end = min(end, start + self.remaining)
+            self.remaining -= end - start
+            self.done = self.remaining == 0
+        return [memoryview(buf)[start:end]] if end > start else []
+    
+    def finish(self):
+        if self.remaining:
+            raise ConnectionError(f'Connection closed with {self.remaining} bytes still to come')
+
+class _ChunkedBody:
+    """Decodes chunked transfer encoding in place: data comes back as views into the buffer"""
+    
+    def __init__(self):
+        self.state = 'size'
+        self.left = 0
+        self.line = b''
+        self.done = False
+    
+    def feed(self, buf, start, end):
+        view = memoryview(buf)
+        segments = []
+        pos = start
+        while pos < end and not self.done:
+            if self.state == 'data':
+                n = min(self.left, end - pos)
+                segments.append(view[pos:pos + n])
+                pos += n
+                self.left -= n
+                if not self.left:
+                    self.state = 'crlf'
+                continue
+            
+            # Framing lines can straddle two buffers
+            newline = buf.find(b'\n', pos, end)
+            if newline < 0:
+                self.line += buf[pos:end]
+                if len(self.line) > 4096:
+                    raise ValueError('Malformed chunked response')
+                break
+            line = (self.line + buf[pos:newline]).strip()
+            self.line = b''
+            pos = newline + 1
+            
+            if self.state == 'size':
+                self.left = int(line.split(b';')[0], 16)
+                self.state = 'data' if self.left else 'trailer'
+            elif self.state == 'crlf':
+                if line:
+                    raise ValueError('Malformed chunked response')
+                self.state = 'size'
+            elif not line:
+                self.done = True  # empty line after the trailers
+        return segments
+    
+    def finish(self):
+        if not self.done:
+            raise ConnectionError('Connection closed in the middle of a chunked response')
+
+class AsyncTransferEngine:
+    """Runs plain HTTP(S) downloads for a DownloadManager on one asyncio loop.
+    
+    Sockets are non-blocking and read into a shared pool of buffers; disk
+    writes, hashing and SQLite updates go to a couple of IO workers that
+    each keep one database connection. Rows move through the same statuses
+    and stages as with the threaded path. Space is reserved once the response
+    headers give the size, instead of with a separate HEAD request.
+    """
+    
+    def __init__(self, manager):
+        self.manager = manager
+        self.space = manager.space
+        self.pool = BufferPool()
+        self._io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='transfer-io')
+        self._local = threading.local()
+        self._ssl = _ssl_context()
+        self._slots = None
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, name='http-transfers')
+        thread.daemon = True
+        thread.start()
+    
+    def submit(self, download_id):
+        """Queue a download; safe to call from any thread"""
+        asyncio.run_coroutine_threadsafe(self._transfer(download_id), self.loop)
+    
+    def _io(self, fn, *args):
+        return self.loop.run_in_executor(self._io_pool, fn, *args)
+    
+    def _db(self, fn, *args):
+        """Run fn(cursor, *args) on an IO worker with that worker's connection"""
+        def run():
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = sqlite3.connect(self.manager.db)
+            try:
+                return fn(conn.cursor(), *args)
+            finally:
+                conn.commit()
+        return self._io(run)
+    
+    async def _request(self, url):
+        """GET url following redirects, returns (connection, headers, body offset)"""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f'Unsupported URL scheme: {parts.scheme}')
+            https = parts.scheme == 'https'
+            
+            _, conn = await asyncio.wait_for(
+                self.loop.create_connection(lambda: _Connection(self.pool), parts.hostname,
+                                            parts.port or (443 if https else 80),
+                                            ssl=self._ssl if https else None),
+                CONNECT_TIMEOUT)
+            try:
+                target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+                conn.transport.write(
+                    f'GET {target} HTTP/1.1\r\n'
+                    f'Host: {parts.netloc.rpartition("@")[2]}\r\n'
+                    f'User-Agent: {USER_AGENT}\r\n'
+                    'Accept: */*\r\n'
+                    'Accept-Encoding: identity\r\n'
+                    'Connection: close\r\n\r\n'.encode('latin-1'))
+                head, body_start = await conn.read_head()
+                status, reason, headers = _parse_head(head)
+            except BaseException:
+                conn.close()
+                raise
+            
+            if status in (301, 302, 303, 307, 308) and headers.get('location'):
+                conn.close()
+                url = urljoin(url, headers['location'])
+                continue
+            if status >= 400:
+                conn.close()
+                kind = 'Client' if status < 500 else 'Server'
+                raise ConnectionError(f'{status} {kind} Error: {reason} for url: {url}')
+            return conn, headers, body_start
+        
+        raise ConnectionError(f'Exceeded {MAX_REDIRECTS} redirects')
+    
+    async def _wait_for_space(self, download_id, size):
+        """Poll until size bytes can be reserved, without blocking the loop"""
+        await self._db(self.manager._set_stage, download_id, 'space_wait')
+        while not self.space.try_reserve(download_id, size):
+            await asyncio.sleep(SPACE_POLL_SECONDS)
+        await self._db(self.manager._set_stage, download_id, 'fetch')
+    
+    async def _transfer(self, download_id):
+        """Download one row. If its size doesn't fit on disk yet, the connection
+        and the slot are given up while waiting for space, then the GET is
+        issued again, so idle servers can't time the job out."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(MAX_TRANSFERS)
+        
+        job = None
+        reserved = False
+        try:
+            while True:
+                async with self._slots:
+                    if job is None:
+                        job = await self._db(self._begin, download_id)
+                        if not job:
+                            return
+                    
+                    conn, headers, body_start = await self._request(job[0])
+                    if 'chunked' in headers.get('transfer-encoding', '').lower():
+                        total_size = 0
+                    else:
+                        total_size = int(headers.get('content-length') or 0)
+                    try:
+                        fits = reserved or self.space.try_reserve(download_id, total_size)
+                    except Exception:
+                        conn.close()
+                        raise
+                    if fits:
+                        await self._fetch(download_id, job, conn, headers, body_start, total_size)
+                        return
+                    conn.close()
+                
+                await self._wait_for_space(download_id, total_size)
+                reserved = True
+        
+        except Exception as e:
+            if job:
+                await self._db(self.manager._fail_file, download_id, None, job[1], str(e) or type(e).__name__)
+        
+        finally:
+            self.space.release(download_id)
+    
+    async def _fetch(self, download_id, job, conn, headers, body_start, total_size):
+        """Stream the response body to disk, closing the connection when done"""
+        url, filepath, checksum_algo, expected_checksum = job
+        f = None
+        
+        try:
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                body = _ChunkedBody()
+            else:
+                length = headers.get('content-length')
+                body = _LengthBody(int(length) if length else None)
+            
+            f = await self._db(self._open_file, download_id, filepath, total_size)
+            # Hash while streaming so completed files never need to be re-read
+            hasher = hashlib.new(checksum_algo or 'sha256')
+            downloaded = 0
+            last_reported = 0
+            
+            # The first buffer also holds the headers; the body starts after them
+            buf, nbytes = conn.swap()
+            start = body_start
+            while True:
+                try:
+                    segments = body.feed(buf, start, nbytes)
+                    if segments:
+                        downloaded += await self._io(_write, f, hasher, segments)
+                finally:
+                    self.pool.put(buf)
+                
+                finished = body.done or (nbytes == 0 and conn.eof)
+                if downloaded - last_reported >= PROGRESS_INTERVAL or (finished and downloaded != last_reported):
+                    last_reported = downloaded
+                    await self._db(self._progress, download_id, downloaded, total_size)
+                if finished:
+                    body.finish()
+                    break
+                
+                buf, nbytes = await conn.take(getattr(body, 'remaining', None))
+                start = 0
+            
+            conn.close()
+            await self._db(self.manager._complete_file, download_id, f, filepath, downloaded, total_size,
+                           hasher.hexdigest(), expected_checksum)
+        
+        except Exception as e:
+            conn.close()
+            await self._db(self.manager._fail_file, download_id, f, filepath, str(e) or type(e).__name__)
+    
+    def _begin(self, c, download_id):
+        c.execute('''SELECT url, filepath, checksum_algo, expected_checksum
+                     FROM downloads WHERE id = ?''', (download_id,))
+        row = c.fetchone()
+        if row:
+            self.manager._set_stage(c, download_id, 'fetch')
+            c.execute('UPDATE downloads SET status = ? WHERE id = ?', ('downloading', download_id))
+        return row
+    
+    def _open_file(self, c, download_id, filepath, total_size):
+        c.execute('UPDATE downloads SET size = ? WHERE id = ?', (total_size, download_id))
+        # Unbuffered: writes go straight from the receive buffer to the file
+        f = open(filepath, 'wb', buffering=0)
+        if total_size and self.manager._preallocate(f, total_size):
+            # The file now owns its blocks, so free space already reflects them
+            self.space.release(download_id)
+        return f
+    
+    def _progress(self, c, download_id, downloaded, total_size):
+        progress = int((downloaded / total_size * 100)) if total_size > 0 else 0
+        c.execute('UPDATE downloads SET progress = ?, downloaded = ? WHERE id = ?',
+                  (progress, downloaded, download_id))